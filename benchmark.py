@@ -0,0 +1,185 @@
+import argparse
+import contextlib
+import json
+import os
+from pathlib import Path
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+WIT_PATH = Path(__file__).resolve().parent / 'wit.py'
+
+
+def read_proc_io():
+    proc_io = Path('/proc/self/io')
+    if not proc_io.is_file():
+        return {}
+    counters = {}
+    for line in proc_io.read_text().splitlines():
+        key, value = line.split(":")
+        counters[key.strip()] = int(value)
+    return counters
+
+
+def run_worker(repo, command, args, jobs):
+    os.chdir(repo)
+    os.environ.setdefault('MPLBACKEND', 'Agg')
+    sys.path.insert(0, os.fspath(WIT_PATH.parent))
+    import_start = time.perf_counter()
+    import wit
+    import_seconds = time.perf_counter() - import_start
+    wit.JOBS = jobs
+
+    error = None
+    io_before = read_proc_io()
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        try:
+            getattr(wit, command)(*args)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+    wall_seconds = time.perf_counter() - start
+    io_after = read_proc_io()
+
+    def io_delta(key):
+        if key not in io_after:
+            return None
+        return io_after[key] - io_before[key]
+
+    result = {
+        'wall_seconds': wall_seconds,
+        'import_seconds': import_seconds,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'bytes_read': io_delta('rchar'),
+        'bytes_written': io_delta('wchar'),
+        'read_syscalls': io_delta('syscr'),
+        'write_syscalls': io_delta('syscw'),
+        'error': error,
+    }
+    print(json.dumps(result))
+
+
+def measure(repo, command, args, jobs, label=None):
+    worker_command = [
+        sys.executable, os.fspath(Path(__file__).resolve()), '--worker',
+        os.fspath(repo), command, json.dumps(args), json.dumps(jobs)
+    ]
+    output = subprocess.run(worker_command, check=True, capture_output=True, text=True).stdout
+    result = json.loads(output.splitlines()[-1])
+    result['command'] = command
+    result['label'] = label or command
+    print(f"{result['label']:<24} {result['wall_seconds']:10.4f}s", file=sys.stderr)
+    return result
+
+
+def make_dir_paths(depth, fan_out):
+    dir_paths = [Path()]
+    level = [Path()]
+    for _ in range(depth):
+        level = [parent / f"dir{index}" for parent in level for index in range(fan_out)]
+        dir_paths.extend(level)
+    return dir_paths
+
+
+def make_files(repo, file_count, file_size, depth, fan_out, rng):
+    dir_paths = make_dir_paths(depth, fan_out)
+    file_names = []
+    for index in range(file_count):
+        name = dir_paths[index % len(dir_paths)] / f"file{index}.txt"
+        (repo / name).parent.mkdir(parents=True, exist_ok=True)
+        (repo / name).write_bytes(rng.randbytes(file_size))
+        file_names.append(name)
+    return file_names
+
+
+def modify_files(repo, file_names, fraction, rng):
+    changed = rng.sample(file_names, max(1, int(len(file_names) * fraction)))
+    for name in changed:
+        with open(repo / name, 'ab') as changed_file:
+            changed_file.write(rng.randbytes(64))
+    return changed
+
+
+def run_benchmark(options):
+    rng = random.Random(options.seed)
+    repo = Path(tempfile.mkdtemp(prefix='wit-bench-'))
+    results = []
+    try:
+        file_names = make_files(repo, options.files, options.size, options.depth, options.fan_out, rng)
+
+        results.append(measure(repo, 'init', [], options.jobs))
+        results.append(measure(repo, 'add', ['.'], options.jobs, 'add (initial)'))
+        results.append(measure(repo, 'commit', ['initial'], options.jobs, 'commit (initial)'))
+        results.append(measure(repo, 'status', [], options.jobs, 'status (clean)'))
+
+        for number in range(1, options.commits):
+            modify_files(repo, file_names, options.change_fraction, rng)
+            results.append(measure(repo, 'status', [], options.jobs, f'status (dirty {number})'))
+            results.append(measure(repo, 'add', ['.'], options.jobs, f'add ({number})'))
+            results.append(measure(repo, 'commit', [f'commit {number}'], options.jobs, f'commit ({number})'))
+
+        for number in range(options.branches):
+            branch_name = f"branch{number}"
+            results.append(measure(repo, 'branch', [branch_name], options.jobs, f'branch ({branch_name})'))
+            results.append(measure(repo, 'checkout', [branch_name], options.jobs, f'checkout ({branch_name})'))
+            modify_files(repo, file_names, options.change_fraction, rng)
+            results.append(measure(repo, 'add', ['.'], options.jobs, f'add ({branch_name})'))
+            results.append(measure(repo, 'commit', [branch_name], options.jobs, f'commit ({branch_name})'))
+            results.append(measure(repo, 'checkout', ['master'], options.jobs, 'checkout (master)'))
+
+        for number in range(options.branches):
+            branch_name = f"branch{number}"
+            results.append(measure(repo, 'merge', [branch_name], options.jobs, f'merge ({branch_name})'))
+
+        results.append(measure(repo, 'graph', [], options.jobs))
+    finally:
+        if options.keep:
+            print(f"repository kept at {repo}", file=sys.stderr)
+        else:
+            shutil.rmtree(repo, ignore_errors=True)
+
+    parameters = {
+        key: value for key, value in vars(options).items() if key not in ('output', 'keep', 'worker')
+    }
+    return {
+        'parameters': parameters,
+        'python': sys.version.split()[0],
+        'platform': sys.platform,
+        'results': results,
+    }
+
+
+def main():
+    if len(sys.argv) == 6 and sys.argv[1] == '--worker':
+        _, _, repo, command, args, jobs = sys.argv
+        run_worker(repo, command, json.loads(args), json.loads(jobs))
+        return
+
+    parser = argparse.ArgumentParser(description="Time every wit command on a synthetic repository.")
+    parser.add_argument('--files', type=int, default=1000, help="number of files in the working tree")
+    parser.add_argument('--size', type=int, default=4096, help="size of each file in bytes")
+    parser.add_argument('--depth', type=int, default=3, help="directory nesting depth")
+    parser.add_argument('--fan-out', type=int, default=4, help="subdirectories per directory")
+    parser.add_argument('--commits', type=int, default=5, help="commits made on master")
+    parser.add_argument('--branches', type=int, default=2, help="branches created and merged back")
+    parser.add_argument('--change-fraction', type=float, default=0.01, help="fraction of files changed per commit")
+    parser.add_argument('--jobs', type=int, default=None, help="worker threads passed to wit")
+    parser.add_argument('--seed', type=int, default=0, help="random seed for the synthetic content")
+    parser.add_argument('--output', '-o', help="write the JSON report to this file instead of stdout")
+    parser.add_argument('--keep', action='store_true', help="keep the synthetic repository")
+    options = parser.parse_args()
+
+    report = json.dumps(run_benchmark(options), indent=2)
+    if options.output:
+        Path(options.output).write_text(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,528 @@
+import hashlib
+import os
+import random
+import shutil
+import subprocess
+import sys
+import time
+
+from pathlib import Path
+
+import pytest
+
+import wit
+
+
+LABELS = (b"HEAD", b"feature")
+
+
+def lines(*items):
+    return [f"{item}\n".encode() for item in items]
+
+
+def lcs_length(a, b):
+    lengths = [[0] * (len(b) + 1) for _ in range(len(a) + 1)]
+    for i in range(len(a) - 1, -1, -1):
+        for j in range(len(b) - 1, -1, -1):
+            if a[i] == b[j]:
+                lengths[i][j] = lengths[i + 1][j + 1] + 1
+            else:
+                lengths[i][j] = max(lengths[i + 1][j], lengths[i][j + 1])
+    return lengths[0][0]
+
+
+def test_match_lines_is_a_longest_common_subsequence():
+    rng = random.Random(0)
+    for _ in range(500):
+        a = [rng.randint(0, 4) for _ in range(rng.randint(0, 20))]
+        b = [rng.randint(0, 4) for _ in range(rng.randint(0, 20))]
+        matches = wit.match_lines(a, b)
+        assert all(a[i] == b[j] for i, j in matches)
+        assert all(x[0] < y[0] and x[1] < y[1] for x, y in zip(matches, matches[1:]))
+        assert len(matches) == lcs_length(a, b)
+
+
+def test_match_lines_with_an_empty_side():
+    assert wit.match_lines([], [1, 2]) == []
+    assert wit.match_lines([1, 2], []) == []
+
+
+def test_match_lines_on_large_disjoint_inputs():
+    a = [f"a{index}" for index in range(20000)]
+    b = [f"b{index}" for index in range(20000)]
+    assert wit.match_lines(a, b) == []
+
+
+def test_merge_lines_clean():
+    base = lines(1, 2, 3, 4, 5)
+    ours = lines(1, "two", 3, 4, 5)
+    theirs = lines(1, 2, 3, 4, "five")
+    assert wit.merge_lines(base, ours, theirs, LABELS) == (lines(1, "two", 3, 4, "five"), 0)
+
+
+def test_merge_lines_same_change_on_both_sides():
+    base = lines(1, 2, 3)
+    changed = lines(1, "two", 3, 4)
+    assert wit.merge_lines(base, changed, changed, LABELS) == (changed, 0)
+
+
+def test_merge_lines_conflict():
+    base = lines(1, 2, 3)
+    ours = lines(1, "ours", 3)
+    theirs = lines(1, "theirs", 3)
+    merged, conflicts = wit.merge_lines(base, ours, theirs, LABELS)
+    assert conflicts == 1
+    assert merged == [
+        b"1\n", b"<<<<<<< HEAD\n", b"ours\n", b"=======\n", b"theirs\n", b">>>>>>> feature\n", b"3\n"
+    ]
+
+
+def test_merge_lines_add_add():
+    merged, conflicts = wit.merge_lines([], lines("a"), lines("b"), LABELS)
+    assert conflicts == 1
+    assert merged == [b"<<<<<<< HEAD\n", b"a\n", b"=======\n", b"b\n", b">>>>>>> feature\n"]
+    assert wit.merge_lines([], lines("a"), lines("a"), LABELS) == (lines("a"), 0)
+
+
+def test_merge_lines_delete():
+    base = lines(1, 2, 3, 4)
+    assert wit.merge_lines(base, lines(1, 3, 4), base, LABELS) == (lines(1, 3, 4), 0)
+    assert wit.merge_lines(base, base, [], LABELS) == ([], 0)
+    merged, conflicts = wit.merge_lines(base, lines(1, 3, 4), lines(1, "two", 3, 4), LABELS)
+    assert conflicts == 1
+    assert merged == [b"1\n", b"<<<<<<< HEAD\n", b"=======\n", b"two\n", b">>>>>>> feature\n", b"3\n", b"4\n"]
+
+
+def test_merge_lines_rewritten_on_both_sides():
+    base = lines(*range(4000))
+    ours = lines(*(f"ours {index}" for index in range(4000)))
+    theirs = lines(*(f"theirs {index}" for index in range(4000)))
+    merged, conflicts = wit.merge_lines(base, ours, theirs, LABELS)
+    assert conflicts == 1
+    assert len(merged) == 8003
+
+
+def test_diff_blocks_for_added_and_deleted_files():
+    text = lines(*range(8000))
+    assert wit.diff_blocks([], text) == [(0, 0, 0, 8000)]
+    assert wit.diff_blocks(text, []) == [(0, 8000, 0, 0)]
+    assert wit.diff_blocks([], []) == []
+
+
+@pytest.fixture
+def repo(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    wit.init()
+    return tmp_path
+
+
+def commit_files(repo, message, files, branch_name=None):
+    for name, text in files.items():
+        path = repo / name
+        if text is None and path.is_dir():
+            shutil.rmtree(path)
+        elif text is None:
+            path.unlink()
+        else:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(text)
+    wit.add(all_files=True)
+    wit.commit(message)
+    if branch_name is not None:
+        wit.branch(branch_name)
+    return wit.get_from_references(repo)['HEAD']
+
+
+def make_directory_and_file_branches(repo):
+    commit_files(repo, "directory", {'x/y': "deep"}, 'directory')
+    commit_files(repo, "no x", {'x': None})
+    commit_files(repo, "file", {'x': "file"}, 'file')
+
+
+def test_checkout_replaces_a_directory_with_a_file(repo):
+    make_directory_and_file_branches(repo)
+    wit.checkout('directory')
+    assert (repo / 'x' / 'y').read_text() == "deep"
+    wit.checkout('file')
+    assert (repo / 'x').read_text() == "file"
+
+
+def test_checkout_refuses_to_overwrite_an_untracked_directory(repo):
+    make_directory_and_file_branches(repo)
+    wit.checkout('directory')
+    (repo / 'x' / 'extra').write_text("untracked")
+    with pytest.raises(wit.CheckoutError):
+        wit.checkout('file')
+    assert (repo / 'x' / 'y').read_text() == "deep"
+
+
+def test_checkout_refuses_to_overwrite_an_untracked_file(repo):
+    commit_files(repo, "base", {'a': "a"}, 'base')
+    commit_files(repo, "b", {'b': "theirs"}, 'with-b')
+    wit.checkout('base')
+    (repo / 'b').write_text("my precious untracked")
+    with pytest.raises(wit.CheckoutError):
+        wit.checkout('with-b')
+    assert (repo / 'b').read_text() == "my precious untracked"
+    assert wit.get_from_references(repo)['HEAD'] == wit.get_branch(repo, 'base')
+
+
+def test_merge_connector_reaches_a_new_lane():
+    node = wit.CommitNode
+    commits = [
+        ('h1', node(('a',), 5)), ('h2', node(('b',), 5)), ('a', node(('c', 'z'), 4)),
+        ('b', node(('c',), 3)), ('z', node(('c',), 3)), ('c', node((), 1)),
+    ]
+    rows = [item for kind, item in wit.lane_layout_gen(commits) if kind == 'connector']
+    assert rows[0] == "|\\|\\"
+
+
+def test_hardlink_storage_survives_in_place_edits(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    wit.init()
+    wit.config('storage', 'hardlink')
+    (tmp_path / 'a.txt').write_text("original\n")
+    wit.add(all_files=True)
+    wit.commit("original")
+    wit.branch('original')
+    (tmp_path / 'a.txt').write_text("second\n")
+    wit.add(all_files=True)
+    wit.commit("second")
+    wit.checkout('original')
+    assert (tmp_path / 'a.txt').stat().st_nlink == 1
+    with open(tmp_path / 'a.txt', 'a') as edited:
+        edited.write("edit\n")
+    wit.fsck()
+
+
+def test_commit_refuses_unresolved_merge_conflicts(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    wit.init()
+    (tmp_path / 'a.txt').write_text("base\n")
+    wit.add(all_files=True)
+    wit.commit("base")
+    wit.branch('other')
+    (tmp_path / 'a.txt').write_text("ours\n")
+    wit.add(all_files=True)
+    wit.commit("ours")
+    wit.checkout('other')
+    (tmp_path / 'a.txt').write_text("theirs\n")
+    wit.add(all_files=True)
+    wit.commit("theirs")
+    wit.checkout('master')
+
+    wit.merge('other')
+    assert b"theirs" in (tmp_path / 'a.txt').read_bytes()
+    with pytest.raises(wit.MergeError):
+        wit.commit("merged")
+
+    (tmp_path / 'a.txt').write_text("ours and theirs\n")
+    wit.add('a.txt')
+    wit.commit("merged")
+    head = wit.get_from_references(tmp_path)['HEAD']
+    assert len(wit.get_commit_node(tmp_path, head).parents) == 2
+    assert not wit.get_merge_conflicts_path(tmp_path).exists()
+
+
+def test_delta_round_trip():
+    rng = random.Random(1)
+    base = bytes(rng.randrange(256) for _ in range(5000))
+    targets = [
+        b"", base, base[:100], base[2500:] + base[:2500], base[:1000] + b"inserted" + base[1000:],
+        base[:4000] + bytes(rng.randrange(256) for _ in range(3000)), b"x" * 10000,
+    ]
+    for target in targets:
+        assert wit.apply_delta(base, wit.make_delta(base, target)) == target
+    assert wit.apply_delta(b"", wit.make_delta(b"", base)) == base
+    edited = base[:2000] + b"edit" + base[2004:]
+    assert len(wit.make_delta(base, edited)) < 200
+    with pytest.raises(wit.ObjectError):
+        wit.apply_delta(base[1:], wit.make_delta(base, edited))
+
+
+def test_find_in_pack_index_finds_every_id(tmp_path):
+    rng = random.Random(2)
+    raw_ids = {bytes([0] * 20), bytes([0xff] * 20), bytes([0]) + bytes(19 * [0xff]), bytes([0xff]) + bytes(19)}
+    raw_ids.update(bytes(rng.randrange(256) for _ in range(20)) for _ in range(500))
+    offsets = {raw_id.hex(): position * 7 for position, raw_id in enumerate(sorted(raw_ids))}
+    index_path = tmp_path / 'pack-test.idx'
+    wit.write_pack_index(index_path, offsets)
+    index_map = index_path.read_bytes()
+    for object_id, offset in offsets.items():
+        assert wit.find_in_pack_index(index_map, len(offsets), bytes.fromhex(object_id)) == offset
+    for raw_id in (bytes([0] * 19 + [1]), bytes([0xff] * 19 + [0xfe]), bytes([0x80] * 20)):
+        if raw_id not in raw_ids:
+            assert wit.find_in_pack_index(index_map, len(offsets), raw_id) is None
+    assert index_path.stat().st_mode & 0o777 == wit.OBJECT_MODE
+
+
+def test_repack_with_delta_chains_then_checkout(repo):
+    lines = [f"line {index} of a file that changes a little in every commit\n" for index in range(400)]
+    versions = []
+    for version in range(6):
+        lines[version * 50] = f"changed in version {version}\n"
+        versions.append("".join(lines))
+        commit_files(repo, f"version {version}", {'a.txt': versions[-1]}, f"v{version}")
+
+    wit.repack()
+    packs = wit.load_packs(repo)
+    assert len(packs) == 1
+    assert not list(wit.loose_objects_gen(repo))
+    kinds = []
+    for object_id in wit.packed_objects_gen(repo):
+        pack_map, offset = wit.find_packed_object(repo, object_id)
+        kinds.append(pack_map[offset])
+    assert kinds.count(wit.PACK_DELTA) >= 4
+
+    for version in (0, 3, 5, 1):
+        wit.checkout(f"v{version}")
+        assert (repo / 'a.txt').read_text() == versions[version]
+    wit.fsck()
+
+
+def ignored(text, name, is_dir=False, rules=()):
+    return wit.is_ignored(list(rules) + [("", wit.compile_ignore_rules(text))], name, is_dir)
+
+
+@pytest.mark.parametrize('text, name, is_dir, expected', [
+    ("foo", "foo", False, True),
+    ("foo", "a/b/foo", False, True),
+    ("foo", "a/b/foo", True, True),
+    ("foo", "foobar", False, False),
+    ("/foo", "foo", False, True),
+    ("/foo", "a/foo", False, False),
+    ("a/foo", "a/foo", False, True),
+    ("a/foo", "b/a/foo", False, False),
+    ("*.log", "deep/x.log", False, True),
+    ("a/*.log", "a/b/x.log", False, False),
+    ("**/foo", "foo", False, True),
+    ("**/foo", "a/b/foo", False, True),
+    ("a/**/b", "a/b", False, True),
+    ("a/**/b", "a/x/y/b", False, True),
+    ("a/**/b", "c/a/x/b", False, False),
+    ("build/", "build", True, True),
+    ("build/", "build", False, False),
+    ("build/", "src/build", True, True),
+    ("/build/", "src/build", True, False),
+    ("*.log\n!keep.log", "keep.log", False, False),
+    ("*.log\n!keep.log", "drop.log", False, True),
+    ("!keep.log\n*.log", "keep.log", False, True),
+    ("*.log\n!*.log\n*.log", "x.log", False, True),
+    ("\\#notes", "#notes", False, True),
+    ("#notes", "#notes", False, False),
+    ("\\!important", "!important", False, True),
+    ("!important", "!important", False, False),
+    ("file[0-9].txt", "file7.txt", False, True),
+    ("file[!0-9].txt", "file7.txt", False, False),
+    ("?.txt", "a/b.txt", False, True),
+    ("trailing   ", "trailing", False, True),
+])
+def test_ignore_patterns(text, name, is_dir, expected):
+    assert ignored(text, name, is_dir) == expected
+
+
+def test_nested_ignore_files_apply_below_their_directory(repo):
+    (repo / '.witignore').write_text("*.tmp\n/top.txt\n")
+    (repo / 'sub').mkdir()
+    (repo / 'sub' / '.witignore').write_text("!keep.tmp\n/local.txt\n")
+    rules = wit.get_ignore_rules(repo, repo / 'sub')
+    assert [base for base, _ in rules] == ["", "sub/"]
+    assert wit.is_ignored(rules, "sub/drop.tmp", False)
+    assert not wit.is_ignored(rules, "sub/keep.tmp", False)
+    assert wit.is_ignored(rules, "keep.tmp", False)
+    assert wit.is_ignored(rules, "top.txt", False)
+    assert not wit.is_ignored(rules, "sub/top.txt", False)
+    assert wit.is_ignored(rules, "sub/local.txt", False)
+    assert not wit.is_ignored(rules, "local.txt", False)
+    assert not wit.is_ignored(rules, "sub/deeper/local.txt", False)
+
+
+def test_working_dirs_gen_never_enters_ignored_directories(repo, monkeypatch):
+    (repo / '.witignore').write_text("node_modules/\n")
+    for name in ('src/a.py', 'node_modules/pkg/index.js', 'src/node_modules/x.js'):
+        (repo / name).parent.mkdir(parents=True, exist_ok=True)
+        (repo / name).write_text("")
+    scanned = []
+    list_dir = wit.list_dir
+    monkeypatch.setattr(wit, 'list_dir', lambda dirpath: scanned.append(dirpath) or list_dir(dirpath))
+    assert sorted(wit.working_files_gen(repo, repo)) == ['.witignore', 'src/a.py']
+    assert not [dirpath for dirpath in scanned if 'node_modules' in dirpath]
+
+
+def make_repos(tmp_path, monkeypatch, *names):
+    for name in names:
+        (tmp_path / name).mkdir()
+        monkeypatch.chdir(tmp_path / name)
+        wit.init()
+    return [tmp_path / name for name in names]
+
+
+def last_line(capsys):
+    return capsys.readouterr().out.strip().splitlines()[-1]
+
+
+def test_push_sends_only_missing_objects(tmp_path, monkeypatch, capsys):
+    origin, local = make_repos(tmp_path, monkeypatch, 'origin', 'local')
+    wit.remote('add', 'origin', '../origin')
+    commit_files(local, "one", {'a.txt': "a\n", 'b.txt': "b\n", 'd/c.txt': "c\n"})
+    wit.push('origin')
+    assert last_line(capsys) == "pushed 1 commits and 6 objects to origin"
+    commit_files(local, "two", {'a.txt': "a2\n"})
+    wit.push('origin')
+    assert last_line(capsys) == "pushed 1 commits and 3 objects to origin"
+    wit.push('origin')
+    assert last_line(capsys) == "everything up to date"
+    head = wit.get_branch(local, 'master')
+    assert wit.load_references(origin)['master'] == head
+    assert wit.load_references(local)['origin/master'] == head
+
+    wit.fsck()
+    monkeypatch.chdir(origin)
+    wit.fsck()
+
+
+def test_fetch_into_a_fresh_repository(tmp_path, monkeypatch, capsys):
+    origin, clone = make_repos(tmp_path, monkeypatch, 'origin', 'clone')
+    monkeypatch.chdir(origin)
+    commit_files(origin, "one", {'a.txt': "a\n"})
+    head = commit_files(origin, "two", {'d/b.txt': "b\n"}, 'side')
+
+    monkeypatch.chdir(clone)
+    wit.remote('add', 'origin', '../origin')
+    wit.fetch('origin')
+    assert capsys.readouterr().out.splitlines() == [
+        "fetched 2 commits and 7 objects from origin", "branch master set to origin/master"
+    ]
+    references = wit.load_references(clone)
+    assert references['master'] == references['origin/master'] == references['origin/side'] == head
+    assert 'side' not in references
+    wit.fetch('origin')
+    assert last_line(capsys) == "fetched 0 commits and 0 objects from origin"
+
+    wit.checkout('origin/side')
+    assert wit.load_activated(clone) == 'side'
+    assert wit.get_branch(clone, 'side') == head
+    assert (clone / 'd' / 'b.txt').read_text() == "b\n"
+    wit.fsck()
+    monkeypatch.chdir(origin)
+    wit.fsck()
+
+
+def test_push_refuses_diverged_and_checked_out_branches(tmp_path, monkeypatch):
+    origin, local, other = make_repos(tmp_path, monkeypatch, 'origin', 'local', 'other')
+    monkeypatch.chdir(local)
+    wit.remote('add', 'origin', '../origin')
+    commit_files(local, "one", {'a.txt': "a\n"}, 'feature')
+    wit.push('origin', 'feature')
+
+    monkeypatch.chdir(other)
+    wit.remote('add', 'origin', '../origin')
+    wit.fetch('origin')
+    wit.checkout('origin/feature')
+    theirs = commit_files(other, "theirs", {'a.txt': "theirs\n"})
+    wit.push('origin', 'feature')
+
+    monkeypatch.chdir(local)
+    wit.checkout('feature')
+    commit_files(local, "ours", {'a.txt': "ours\n"})
+    with pytest.raises(wit.BranchError, match="fetch the remote changes first"):
+        wit.push('origin', 'feature')
+    wit.fetch('origin')
+    with pytest.raises(wit.BranchError, match="not a fast-forward"):
+        wit.push('origin', 'feature')
+    assert wit.load_references(origin)['feature'] == theirs
+
+    monkeypatch.chdir(origin)
+    wit.checkout('feature')
+    monkeypatch.chdir(other)
+    commit_files(other, "more", {'b.txt': "b\n"})
+    with pytest.raises(wit.BranchError, match="checked out in the remote"):
+        wit.push('origin', 'feature')
+    assert wit.load_references(origin)['feature'] == theirs
+    for repo_path in (origin, local, other):
+        monkeypatch.chdir(repo_path)
+        wit.fsck()
+
+
+def test_write_references_keeps_fixed_names_first(tmp_path):
+    references = tmp_path / 'references.txt'
+    wit.write_references(references, {'zeta': "1", 'master': "2"}, None, wit.FIXED_REFERENCES)
+    wit.write_references(references, {'alpha': "3", 'HEAD': "2"}, None, wit.FIXED_REFERENCES)
+    assert references.read_text().splitlines() == [
+        "HEAD=2", "master=2", "added=None", "zeta=1", "alpha=3"
+    ]
+
+
+def test_write_references_checks_expected_values(tmp_path):
+    references = tmp_path / 'references.txt'
+    wit.write_references(references, {'master': "1"}, None, wit.FIXED_REFERENCES)
+    wit.write_references(references, {'master': "2", 'new': "2"}, {'master': "1", 'new': None}, wit.FIXED_REFERENCES)
+    text = references.read_text()
+    with pytest.raises(wit.BranchError):
+        wit.write_references(references, {'master': "3"}, {'master': "1"}, wit.FIXED_REFERENCES)
+    assert references.read_text() == text
+    assert not (tmp_path / 'references.txt.lock').exists()
+
+
+def test_lock_times_out_behind_a_running_owner(tmp_path, monkeypatch):
+    monkeypatch.setattr(wit, 'LOCK_TIMEOUT', 0.05)
+    references = tmp_path / 'references.txt'
+    (tmp_path / 'references.txt.lock').write_text(str(os.getpid()))
+    with pytest.raises(wit.LockError, match=f"held by process {os.getpid()}"):
+        wit.write_references(references, {'master': "1"}, None, wit.FIXED_REFERENCES)
+    assert not references.exists()
+
+
+def test_lock_left_by_a_dead_process_is_reported(tmp_path, monkeypatch):
+    monkeypatch.setattr(wit, 'LOCK_TIMEOUT', 60)
+    dead = subprocess.Popen([sys.executable, '-c', 'pass'])
+    dead.wait()
+    (tmp_path / 'references.txt.lock').write_text(str(dead.pid))
+    started = time.monotonic()
+    with pytest.raises(wit.LockError, match=f"stale lock left by process {dead.pid}"):
+        wit.write_references(tmp_path / 'references.txt', {'master': "1"}, None, wit.FIXED_REFERENCES)
+    assert time.monotonic() - started < 5
+
+
+def corrupt(path, offset):
+    path.chmod(0o644)
+    data = bytearray(path.read_bytes())
+    data[offset] ^= 0xff
+    path.write_bytes(bytes(data))
+
+
+def test_fsck_reports_a_corrupt_loose_object(repo, capsys):
+    commit_files(repo, "one", {'a.txt': "a\n", 'b.txt': "b\n"})
+    wit.fsck()
+    object_id = wit.hash_file(repo / 'a.txt')
+    corrupt(wit.get_object_path(repo, object_id), 0)
+    with pytest.raises(wit.ObjectError):
+        wit.fsck()
+    assert f"corrupt loose object {object_id}" in capsys.readouterr().out
+
+
+def test_fsck_reports_a_corrupt_pack(repo, capsys):
+    commit_files(repo, "one", {'a.txt': "a\n" * 100, 'b.txt': "b\n"})
+    wit.repack()
+    wit.fsck()
+    pack_path = wit.load_packs(repo)[0][0].with_suffix('.pack')
+    corrupt(pack_path, pack_path.stat().st_size // 2)
+    wit.PACKS.clear()
+    with pytest.raises(wit.ObjectError):
+        wit.fsck()
+    assert f"corrupt pack {pack_path.name}" in capsys.readouterr().out
+
+
+def test_commit_ids_are_content_hashes(repo):
+    commit_text = "tree=0\nparent=None\ndate=Sat Oct 17 12:00:00 2026\nmessage=same"
+    commit_id = wit.make_commit_id(repo, commit_text)
+    assert commit_id.name == hashlib.sha1(commit_text.encode()).hexdigest()
+    wit.make_commit_text_file(repo, commit_id, commit_text)
+    wit.make_commit_text_file(repo, commit_id, commit_text)
+    assert wit.commit_exists(commit_id)
+    assert wit.has_object(repo, commit_id.name)
+
+    other_id = wit.make_commit_id(repo, commit_text + "\n")
+    Path(f"{other_id}.txt").write_text("something else")
+    with pytest.raises(wit.CommitIdError):
+        wit.make_commit_text_file(repo, other_id, commit_text + "\n")
@@ -1,13 +1,103 @@
+import argparse
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
 import datetime
-import filecmp
+import functools
+import fnmatch
+import hashlib
+import heapq
+import io
+import itertools
+import json
+import mmap
 import os
 from pathlib import Path
-import random
+import re
+import select
+import shlex
 import shutil
+import socket
+import stat
+import struct
 import sys
-
-import matplotlib.pyplot as plt
-import networkx as nx
+import tempfile
+import threading
+import time
+import zlib
+
+
+JOBS = None
+TRACER = None
+NO_SPAN = contextlib.nullcontext()
+PACKS = {}
+COMMIT_GRAPHS = {}
+REFERENCES = collections.OrderedDict()
+CONFIGS = collections.OrderedDict()
+COMMIT_INFOS = collections.OrderedDict()
+TREES = collections.OrderedDict()
+INDEXES = collections.OrderedDict()
+ACTIVATED = collections.OrderedDict()
+DIR_LISTINGS = collections.OrderedDict()
+IGNORES = collections.OrderedDict()
+SHALLOWS = {}
+WIT_FOLDERS = {}
+CACHE_LOCK = threading.Lock()
+
+PACK_SIGNATURE = b'WPCK'
+PACK_INDEX_SIGNATURE = b'WIDX'
+PACK_VERSION = 1
+PACK_FULL = 1
+PACK_DELTA = 2
+PACK_BATCH = 256
+DELTA_BLOCK = 16
+DELTA_MAX_SIZE = 1 << 22
+DELTA_MAX_DEPTH = 10
+MYERS_MAX_COST = 256
+
+COMMIT_GRAPH_SIGNATURE = b'WCGR'
+COMMIT_GRAPH_VERSION = 1
+COMMIT_GRAPH_RECORD = struct.Struct('>20s20s20sI')
+NO_PARENT = bytes(20)
+
+LOCK_TIMEOUT = 10
+PATH_CACHE_SIZE = 256
+COMMIT_CACHE_SIZE = 1 << 12
+TREE_CACHE_SIZE = 1 << 12
+DIR_CACHE_SIZE = 1 << 16
+LISTING_SETTLE_NS = 2 * 10 ** 9
+
+READ_CHUNK = 1 << 20
+MMAP_THRESHOLD = 1 << 26
+CHUNK_MAGIC = b'wit-chunks\n'
+CHUNK_THRESHOLD = 1 << 25
+CHUNK_MIN = 1 << 18
+CHUNK_MAX = 1 << 22
+CHUNK_ANCHOR = b'\n'
+CHUNK_WINDOW = 64
+CHUNK_MASK = (1 << 12) - 1
+FIXED_REFERENCES = ('HEAD', 'master', 'added')
+WORKTREE_REFERENCES = ('HEAD', 'added')
+IGNORE_FILE = '.witignore'
+OBJECT_MODE = 0o444
+FICLONE = 0x40049409
+
+FSMONITOR_SOCKET = 'fsmonitor.sock'
+FSMONITOR_STATE = 'fsmonitor.txt'
+FSMONITOR_COOKIE = 'fsmonitor-cookie-'
+FSMONITOR_TIMEOUT = 5
+INOTIFY_EVENT = struct.Struct('iIII')
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+INOTIFY_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
 
 
 class NoWitError(Exception):
@@ -41,13 +131,129 @@ class MergeError(Exception):
     pass
 
 
+class ObjectError(Exception):
+    pass
+
+
+class LockError(Exception):
+    pass
+
+
+def start_tracing():
+    global TRACER
+    TRACER = {
+        'events': [],
+        'counters': collections.Counter(),
+        'lock': threading.Lock(),
+        'start': time.perf_counter_ns(),
+    }
+
+
+def stop_tracing():
+    global TRACER
+    tracer, TRACER = TRACER, None
+    return tracer
+
+
+@contextlib.contextmanager
+def trace_span(name):
+    start = time.perf_counter_ns()
+    try:
+        yield
+    finally:
+        TRACER['events'].append((name, start, time.perf_counter_ns(), threading.get_ident()))
+
+
+def span(name):
+    if TRACER is None:
+        return NO_SPAN
+    return trace_span(name)
+
+
+def traced(name):
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if TRACER is None:
+                return func(*args, **kwargs)
+            with trace_span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def count(name, amount=1):
+    if TRACER is not None:
+        with TRACER['lock']:
+            TRACER['counters'][name] += amount
+
+
+def print_profile(tracer, out=None):
+    out = out or sys.stderr
+    totals = {}
+    for name, start, end, _ in tracer['events']:
+        calls, total = totals.get(name, (0, 0))
+        totals[name] = (calls + 1, total + end - start)
+    width = max([len(name) for name in totals] + [len(name) for name in tracer['counters']] + [8])
+    print(f"{'span':<{width}} {'calls':>8} {'total ms':>10}", file=out)
+    for name, (calls, total) in sorted(totals.items(), key=lambda item: -item[1][1]):
+        print(f"{name:<{width}} {calls:>8} {total / 1e6:>10.3f}", file=out)
+    if tracer['counters']:
+        print(f"{'counter':<{width}} {'value':>19}", file=out)
+        for name, value in sorted(tracer['counters'].items()):
+            print(f"{name:<{width}} {value:>19}", file=out)
+
+
+def write_trace(tracer, trace_path):
+    pid = os.getpid()
+    events = [
+        {
+            'name': name, 'cat': 'wit', 'ph': 'X', 'pid': pid, 'tid': tid,
+            'ts': (start - tracer['start']) / 1000, 'dur': (end - start) / 1000,
+        }
+        for name, start, end, tid in tracer['events']
+    ]
+    end = max((event['ts'] + event['dur'] for event in events), default=0)
+    events.append({'name': 'counters', 'ph': 'C', 'pid': pid, 'tid': 0, 'ts': end, 'args': dict(tracer['counters'])})
+    with open(trace_path, 'w') as trace_file:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, trace_file)
+
+
+CachedValue = collections.namedtuple('CachedValue', ['stat_key', 'value'])
+
+
+def cache_get(cache, key, stat_key=None):
+    with CACHE_LOCK:
+        cached = cache.get(key)
+        if cached is None or cached.stat_key != stat_key:
+            return None
+        cache.move_to_end(key)
+        return cached.value
+
+
+def cache_put(cache, key, value, limit, stat_key=None):
+    with CACHE_LOCK:
+        cache[key] = CachedValue(stat_key, value)
+        cache.move_to_end(key)
+        while len(cache) > limit:
+            cache.popitem(last=False)
+
+
+def get_stat_key(path):
+    try:
+        path_stat = os.stat(path)
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    return (path_stat.st_mtime_ns, path_stat.st_size, path_stat.st_ino)
+
+
 def init():
     working_directory = Path(os.getcwd())
     wit_folder = working_directory / '.wit'
     activated = wit_folder / 'activated.txt'
     paths = (
         wit_folder / 'images',
-        wit_folder / 'staging_area'
+        wit_folder / 'objects'
     )
 
     for path in paths:
@@ -58,127 +264,1472 @@ def init():
             act_file.write('master')
 
 
+@traced('discovery')
 def get_wit_dir(directory, start_from_parent=True):
-    if not start_from_parent:
-        for f in directory.iterdir():
-            if '.wit' == f.name:
-                return directory
-    for wit_dir in directory.parents:
-        for f in wit_dir.iterdir():
-            if '.wit' == f.name:
-                return wit_dir
+    candidates = directory.parents if start_from_parent else [directory, *directory.parents]
+    for wit_dir in candidates:
+        if (wit_dir / '.wit').exists():
+            return wit_dir
     return None
 
 
-def copy(current_dir, new_dir):
-    if not current_dir.exists():
-        print(f"path does not exist: '{current_dir}'")
-    elif current_dir.is_dir():
+def read_key_values(path):
+    values = {}
+    for line in path.read_text().splitlines():
+        if "=" in line:
+            key, value = line.split("=", 1)
+            values[key.strip()] = value.strip()
+    return values
+
+
+def get_wit_folders(wit_directory):
+    folders = WIT_FOLDERS.get(wit_directory)
+    if folders is None:
+        wit_folder = wit_directory / '.wit'
+        common_folder = wit_folder
+        if wit_folder.is_file():
+            wit_folder = Path(read_key_values(wit_folder)['folder'])
+            common_folder = Path(read_key_values(wit_folder / 'worktree.txt')['common'])
+        folders = (wit_folder, common_folder)
+        WIT_FOLDERS[wit_directory] = folders
+    return folders
+
+
+def get_wit_folder(wit_directory):
+    return get_wit_folders(wit_directory)[0]
+
+
+def get_common_folder(wit_directory):
+    return get_wit_folders(wit_directory)[1]
+
+
+def get_images_dir(wit_directory):
+    return get_common_folder(wit_directory) / 'images'
+
+
+def get_config(wit_directory):
+    config_file = get_common_folder(wit_directory) / 'config.txt'
+    stat_key = get_stat_key(config_file)
+    if stat_key is None:
+        return {}
+    config = cache_get(CONFIGS, config_file, stat_key)
+    if config is None:
+        config = read_key_values(config_file)
+        cache_put(CONFIGS, config_file, config, PATH_CACHE_SIZE, stat_key)
+    return dict(config)
+
+
+def set_config(wit_directory, key, value):
+    config = get_config(wit_directory)
+    config[key] = value
+    config_text = "".join(f"{config_key}={config_value}\n" for config_key, config_value in config.items())
+    config_file = get_common_folder(wit_directory) / 'config.txt'
+    temp_path = config_file.with_name(config_file.name + '.tmp')
+    with open(temp_path, 'w') as conf_file:
+        conf_file.write(config_text)
+    os.replace(temp_path, config_file)
+
+
+def config(key, value):
+    working_directory = Path(os.getcwd())
+    wit_directory = get_wit_dir(working_directory, start_from_parent=False)
+    if wit_directory is None:
+        raise NoWitError("No wit folder found", working_directory)
+    set_config(wit_directory, key, value)
+
+
+def get_jobs(wit_directory):
+    if JOBS is not None:
+        return JOBS
+    return int(get_config(wit_directory).get('jobs', 1))
+
+
+def map_jobs(wit_directory, func, items):
+    jobs = get_jobs(wit_directory)
+    if jobs <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(func, items))
+
+
+def get_object_path(wit_directory, object_id):
+    return get_common_folder(wit_directory) / 'objects' / object_id[:2] / object_id[2:]
+
+
+def hash_file(path):
+    file_hash = hashlib.sha1()
+    with open(path, 'rb') as f:
+        file_size = os.fstat(f.fileno()).st_size
+        count('files_read')
+        count('bytes_read', file_size)
+        if file_size >= MMAP_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as file_map:
+                file_hash.update(file_map)
+        else:
+            for piece in iter(lambda: f.read(READ_CHUNK), b''):
+                file_hash.update(piece)
+    return file_hash.hexdigest()
+
+
+def is_chunked(wit_directory, size, head):
+    config = get_config(wit_directory)
+    chunk_threshold = int(config.get('chunk_threshold', CHUNK_THRESHOLD))
+    if config.get('chunking') == 'true' and size >= chunk_threshold:
+        return True
+    return head[:len(CHUNK_MAGIC)] == CHUNK_MAGIC
+
+
+def is_chunked_file(wit_directory, path):
+    with open(path, 'rb') as f:
+        return is_chunked(wit_directory, os.fstat(f.fileno()).st_size, f.read(len(CHUNK_MAGIC)))
+
+
+def find_chunk_boundary(data):
+    if len(data) <= CHUNK_MIN:
+        return len(data)
+    end = min(len(data), CHUNK_MAX)
+    position = data.find(CHUNK_ANCHOR, CHUNK_MIN, end)
+    while position != -1:
+        if not zlib.crc32(data[position - CHUNK_WINDOW:position]) & CHUNK_MASK:
+            return position + 1
+        position = data.find(CHUNK_ANCHOR, position + 1, end)
+    return end
+
+
+def stream_chunks_gen(stream):
+    buffer = b""
+    while True:
+        data = stream.read(CHUNK_MAX)
+        buffer += data
+        while len(buffer) >= CHUNK_MAX or (buffer and not data):
+            boundary = find_chunk_boundary(buffer)
+            yield buffer[:boundary]
+            buffer = buffer[boundary:]
+        if not data:
+            break
+
+
+def file_chunks_gen(path):
+    with open(path, 'rb') as f:
+        yield from stream_chunks_gen(f)
+
+
+def make_chunk_manifest(chunks, chunk_func):
+    lines = [f"{chunk_func(chunk)} {len(chunk)}\n" for chunk in chunks]
+    return CHUNK_MAGIC + "".join(lines).encode()
+
+
+def get_file_id(wit_directory, path):
+    if is_chunked_file(wit_directory, path):
+        manifest = make_chunk_manifest(file_chunks_gen(path), lambda chunk: hashlib.sha1(chunk).hexdigest())
+        return hashlib.sha1(manifest).hexdigest()
+    return hash_file(path)
+
+
+def save_object_file(object_path, write_func, mode=None):
+    object_path.parent.mkdir(parents=True, exist_ok=True)
+    temp_fd, temp_name = tempfile.mkstemp(suffix='.tmp', dir=object_path.parent)
+    os.close(temp_fd)
+    temp_path = Path(temp_name)
+    try:
+        write_func(temp_path)
+        if mode is not None:
+            os.chmod(temp_path, mode)
+        os.replace(temp_path, object_path)
+    finally:
+        temp_path.unlink(missing_ok=True)
+
+
+def materialize_file(wit_directory, source, destination):
+    storage = get_config(wit_directory).get('storage', 'copy')
+    if storage in ('hardlink', 'reflink'):
         try:
-            shutil.copytree(current_dir, new_dir)
-        except FileExistsError:
-            shutil.rmtree(new_dir, ignore_errors=True)
-            shutil.copytree(current_dir, new_dir)
+            import fcntl
+
+            with open(source, 'rb') as source_file, open(destination, 'wb') as destination_file:
+                fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+            return
+        except (ImportError, OSError):
+            pass
+    shutil.copyfile(source, destination)
+
+
+def write_blob(wit_directory, path):
+    if is_chunked_file(wit_directory, path):
+        manifest = make_chunk_manifest(file_chunks_gen(path), lambda chunk: write_object(wit_directory, chunk))
+        return write_object(wit_directory, manifest)
+    object_id = hash_file(path)
+    if not has_object(wit_directory, object_id):
+        object_path = get_object_path(wit_directory, object_id)
+        save_object_file(
+            object_path, lambda temp_path: materialize_file(wit_directory, path, temp_path), OBJECT_MODE
+        )
+        count('files_written')
+        count('bytes_written', os.path.getsize(object_path))
+    return object_id
+
+
+def write_blob_data(wit_directory, data):
+    if is_chunked(wit_directory, len(data), data):
+        chunks = stream_chunks_gen(io.BytesIO(data))
+        return write_object(wit_directory, make_chunk_manifest(chunks, lambda chunk: write_object(wit_directory, chunk)))
+    return write_object(wit_directory, data)
+
+
+def write_object(wit_directory, data):
+    object_id = hashlib.sha1(data).hexdigest()
+    if not has_object(wit_directory, object_id):
+        object_path = get_object_path(wit_directory, object_id)
+        save_object_file(object_path, lambda temp_path: temp_path.write_bytes(data), OBJECT_MODE)
+        count('files_written')
+        count('bytes_written', len(data))
+    return object_id
+
+
+def has_object(wit_directory, object_id):
+    if get_object_path(wit_directory, object_id).is_file():
+        return True
+    return find_packed_object(wit_directory, object_id) is not None
+
+
+def read_object(wit_directory, object_id):
+    object_path = get_object_path(wit_directory, object_id)
+    if object_path.is_file():
+        data = object_path.read_bytes()
+        count('files_read')
+        count('bytes_read', len(data))
+        return data
+    packed = find_packed_object(wit_directory, object_id)
+    if packed is None:
+        raise ObjectError("object not found", object_id)
+    pack_map, offset = packed
+    return read_pack_entry(wit_directory, pack_map, offset)
+
+
+def write_tree(wit_directory, directory):
+    lines = []
+    for entry in sorted(directory.iterdir(), key=lambda entry: entry.name):
+        if entry.is_dir():
+            lines.append(f"tree {write_tree(wit_directory, entry)} {entry.name}\n")
+        else:
+            lines.append(f"blob {write_blob(wit_directory, entry)} {entry.name}\n")
+    return write_object(wit_directory, "".join(lines).encode())
+
+
+def read_tree(wit_directory, tree_id):
+    key = (get_common_folder(wit_directory), tree_id)
+    entries = cache_get(TREES, key)
+    if entries is None:
+        entries = tuple(
+            tuple(line.split(" ", 2)) for line in read_object(wit_directory, tree_id).decode().splitlines()
+        )
+        cache_put(TREES, key, entries, TREE_CACHE_SIZE)
+    return entries
+
+
+def tree_files(wit_directory, tree_id, prefix="", sparse=()):
+    files = {}
+    for kind, object_id, name in read_tree(wit_directory, tree_id):
+        path = prefix + name
+        if kind == 'tree':
+            if in_sparse(path, sparse) or is_sparse_parent(path, sparse):
+                files.update(tree_files(wit_directory, object_id, path + "/", sparse))
+        elif in_sparse(path, sparse):
+            files[path] = object_id
+    return files
+
+
+def diff_trees_gen(wit_directory, old_tree_id, new_tree_id, prefix=""):
+    if old_tree_id == new_tree_id:
+        return
+    old_entries = {}
+    new_entries = {}
+    if old_tree_id is not None:
+        old_entries = {name: (kind, object_id) for kind, object_id, name in read_tree(wit_directory, old_tree_id)}
+    if new_tree_id is not None:
+        new_entries = {name: (kind, object_id) for kind, object_id, name in read_tree(wit_directory, new_tree_id)}
+    for name in sorted(old_entries.keys() | new_entries.keys()):
+        old_kind, old_id = old_entries.get(name, (None, None))
+        new_kind, new_id = new_entries.get(name, (None, None))
+        if (old_kind, old_id) == (new_kind, new_id):
+            continue
+        path = prefix + name
+        if old_kind == 'tree' or new_kind == 'tree':
+            yield from diff_trees_gen(
+                wit_directory,
+                old_id if old_kind == 'tree' else None,
+                new_id if new_kind == 'tree' else None,
+                path + "/",
+            )
+        if old_kind == 'blob' or new_kind == 'blob':
+            yield path, old_id if old_kind == 'blob' else None, new_id if new_kind == 'blob' else None
+
+
+def diff_files_gen(old_files, new_files):
+    for name in sorted(old_files.keys() | new_files.keys()):
+        old_id = old_files.get(name)
+        new_id = new_files.get(name)
+        if old_id != new_id:
+            yield name, old_id, new_id
+
+
+def object_chunks_gen(wit_directory, object_id):
+    object_path = get_object_path(wit_directory, object_id)
+    if object_path.is_file():
+        count('files_read')
+        with open(object_path, 'rb') as object_file:
+            for piece in iter(lambda: object_file.read(READ_CHUNK), b''):
+                count('bytes_read', len(piece))
+                yield piece
+        return
+    packed = find_packed_object(wit_directory, object_id)
+    if packed is None:
+        raise ObjectError("object not found", object_id)
+    pack_map, offset = packed
+    yield from pack_entry_chunks_gen(wit_directory, pack_map, offset)
+
+
+def blob_chunks_gen(wit_directory, object_id):
+    pieces = object_chunks_gen(wit_directory, object_id)
+    head = b""
+    for piece in pieces:
+        head += piece
+        if len(head) >= len(CHUNK_MAGIC):
+            break
+    if not head.startswith(CHUNK_MAGIC):
+        if head:
+            yield head
+        yield from pieces
+        return
+    manifest = head + b"".join(pieces)
+    for line in manifest[len(CHUNK_MAGIC):].decode().splitlines():
+        chunk_id, _ = line.split(" ", 1)
+        yield from object_chunks_gen(wit_directory, chunk_id)
+
+
+def read_blob(wit_directory, object_id):
+    return b"".join(blob_chunks_gen(wit_directory, object_id))
+
+
+def is_raw_loose_object(object_path):
+    try:
+        with open(object_path, 'rb') as object_file:
+            return object_file.read(len(CHUNK_MAGIC)) != CHUNK_MAGIC
+    except FileNotFoundError:
+        return False
+
+
+def copy_blob(wit_directory, object_id, new_file):
+    new_file.parent.mkdir(parents=True, exist_ok=True)
+    object_path = get_object_path(wit_directory, object_id)
+    if is_raw_loose_object(object_path):
+        materialize_file(wit_directory, object_path, new_file)
+        return
+    with open(new_file, 'wb') as blob_file:
+        for piece in blob_chunks_gen(wit_directory, object_id):
+            blob_file.write(piece)
+
+
+def get_pack_dir(wit_directory):
+    return get_common_folder(wit_directory) / 'objects' / 'pack'
+
+
+def load_packs(wit_directory):
+    pack_dir = get_pack_dir(wit_directory)
+    if not pack_dir.is_dir():
+        return []
+    pack_dir_time = pack_dir.stat().st_mtime_ns
+    cached = PACKS.get(pack_dir)
+    if cached is not None and cached[0] == pack_dir_time:
+        return cached[1]
+
+    packs = []
+    for index_path in sorted(pack_dir.glob('pack-*.idx')):
+        with open(index_path, 'rb') as index_file:
+            index_map = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        with open(index_path.with_suffix('.pack'), 'rb') as pack_file:
+            pack_map = mmap.mmap(pack_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if index_map[:4] != PACK_INDEX_SIGNATURE or pack_map[:4] != PACK_SIGNATURE:
+            raise ObjectError("invalid pack file", index_path)
+        object_count = struct.unpack_from('>I', index_map, 8 + 255 * 4)[0]
+        packs.append((index_path, index_map, pack_map, object_count))
+    PACKS[pack_dir] = (pack_dir_time, packs)
+    return packs
+
+
+def find_in_pack_index(index_map, object_count, raw_id):
+    ids_start = 8 + 256 * 4
+    first = raw_id[0]
+    low = struct.unpack_from('>I', index_map, 8 + (first - 1) * 4)[0] if first else 0
+    high = struct.unpack_from('>I', index_map, 8 + first * 4)[0]
+    while low < high:
+        middle = (low + high) // 2
+        start = ids_start + middle * 20
+        current = index_map[start:start + 20]
+        if current < raw_id:
+            low = middle + 1
+        elif current > raw_id:
+            high = middle
+        else:
+            return struct.unpack_from('>Q', index_map, ids_start + object_count * 20 + middle * 8)[0]
+    return None
+
+
+def find_packed_object(wit_directory, object_id):
+    raw_id = bytes.fromhex(object_id)
+    for _, index_map, pack_map, object_count in load_packs(wit_directory):
+        offset = find_in_pack_index(index_map, object_count, raw_id)
+        if offset is not None:
+            return pack_map, offset
+    return None
+
+
+def packed_objects_gen(wit_directory):
+    ids_start = 8 + 256 * 4
+    for _, index_map, _, object_count in load_packs(wit_directory):
+        for position in range(object_count):
+            start = ids_start + position * 20
+            yield index_map[start:start + 20].hex()
+
+
+def pack_entry_chunks_gen(wit_directory, pack_map, offset):
+    kind, size = struct.unpack_from('>BQ', pack_map, offset)
+    if kind == PACK_DELTA:
+        yield read_pack_entry(wit_directory, pack_map, offset)
+        return
+    start = offset + 9
+    decompressor = zlib.decompressobj()
+    for position in range(start, start + size, READ_CHUNK):
+        piece = decompressor.decompress(pack_map[position:min(position + READ_CHUNK, start + size)])
+        if piece:
+            yield piece
+    piece = decompressor.flush()
+    if piece:
+        yield piece
+
+
+def read_pack_entry(wit_directory, pack_map, offset):
+    kind, size = struct.unpack_from('>BQ', pack_map, offset)
+    offset += 9
+    if kind == PACK_DELTA:
+        base_id = pack_map[offset:offset + 20].hex()
+        offset += 20
+        delta = zlib.decompress(pack_map[offset:offset + size])
+        return apply_delta(read_object(wit_directory, base_id), delta)
+    return zlib.decompress(pack_map[offset:offset + size])
+
+
+def make_delta(base, target):
+    blocks = {}
+    for offset in range(0, len(base) - DELTA_BLOCK + 1, DELTA_BLOCK):
+        blocks.setdefault(base[offset:offset + DELTA_BLOCK], offset)
+
+    delta = [struct.pack('>QQ', len(base), len(target))]
+    insert_start = 0
+    position = 0
+    while position + DELTA_BLOCK <= len(target):
+        base_offset = blocks.get(target[position:position + DELTA_BLOCK])
+        if base_offset is None:
+            position += 1
+            continue
+        while position > insert_start and base_offset > 0 and base[base_offset - 1] == target[position - 1]:
+            base_offset -= 1
+            position -= 1
+        length = 0
+        while base_offset + length < len(base) and position + length < len(target):
+            step = min(64, len(base) - base_offset - length, len(target) - position - length)
+            if base[base_offset + length:base_offset + length + step] == target[position + length:position + length + step]:
+                length += step
+            elif base[base_offset + length] == target[position + length]:
+                length += 1
+            else:
+                break
+        if position > insert_start:
+            delta.append(struct.pack('>BQ', 1, position - insert_start) + target[insert_start:position])
+        delta.append(struct.pack('>BQQ', 0, base_offset, length))
+        position += length
+        insert_start = position
+    if insert_start < len(target):
+        delta.append(struct.pack('>BQ', 1, len(target) - insert_start) + target[insert_start:])
+    return b"".join(delta)
+
+
+def apply_delta(base, delta):
+    base_size, target_size = struct.unpack_from('>QQ', delta, 0)
+    if base_size != len(base):
+        raise ObjectError("delta base size mismatch", base_size, len(base))
+    target = []
+    position = 16
+    while position < len(delta):
+        if delta[position] == 0:
+            _, base_offset, length = struct.unpack_from('>BQQ', delta, position)
+            target.append(base[base_offset:base_offset + length])
+            position += 17
+        else:
+            _, length = struct.unpack_from('>BQ', delta, position)
+            position += 9
+            target.append(delta[position:position + length])
+            position += length
+    target = b"".join(target)
+    if len(target) != target_size:
+        raise ObjectError("delta target size mismatch", target_size, len(target))
+    return target
+
+
+def loose_objects_gen(wit_directory):
+    objects_dir = get_common_folder(wit_directory) / 'objects'
+    for prefix_dir in sorted(objects_dir.iterdir()):
+        if len(prefix_dir.name) != 2 or not prefix_dir.is_dir():
+            continue
+        for object_file in sorted(prefix_dir.iterdir()):
+            if not object_file.name.endswith('.tmp'):
+                yield prefix_dir.name + object_file.name
+
+
+def get_object_size(wit_directory, object_id):
+    object_path = get_object_path(wit_directory, object_id)
+    if object_path.is_file():
+        return object_path.stat().st_size
+    return sum(len(piece) for piece in object_chunks_gen(wit_directory, object_id))
+
+
+def get_delta_depth(delta_bases, object_id):
+    depth = 0
+    while object_id in delta_bases:
+        object_id = delta_bases[object_id]
+        depth += 1
+    return depth
+
+
+def find_delta_bases(wit_directory, object_ids, commit_names=None):
+    versions = {}
+    if commit_names is None:
+        images = get_images_dir(wit_directory)
+        commit_names = [commit_file.stem for commit_file in images.glob('*.txt')]
+    for commit_name in sorted(commit_names):
+        tree_id = get_commit_tree(wit_directory, commit_name)
+        for name, object_id in tree_files(wit_directory, tree_id).items():
+            if object_id in object_ids:
+                versions.setdefault(name, set()).add(object_id)
+
+    sizes = {}
+    delta_bases = {}
+    for name in sorted(versions):
+        if len(versions[name]) < 2:
+            continue
+        for object_id in versions[name]:
+            if object_id not in sizes:
+                sizes[object_id] = get_object_size(wit_directory, object_id)
+        candidates = sorted(versions[name], key=lambda object_id: (-sizes[object_id], object_id))
+        for base_id, object_id in zip(candidates, candidates[1:]):
+            if object_id in delta_bases or max(sizes[object_id], sizes[base_id]) > DELTA_MAX_SIZE:
+                continue
+            base_chain = base_id
+            while base_chain in delta_bases and base_chain != object_id:
+                base_chain = delta_bases[base_chain]
+            if base_chain == object_id or get_delta_depth(delta_bases, base_id) >= DELTA_MAX_DEPTH:
+                continue
+            delta_bases[object_id] = base_id
+    return delta_bases
+
+
+def make_pack_entry(wit_directory, object_id, base_id):
+    if base_id is not None:
+        data = read_object(wit_directory, object_id)
+        delta = make_delta(read_object(wit_directory, base_id), data)
+        if len(delta) < len(data) // 2:
+            compressed = zlib.compress(delta)
+            return struct.pack('>BQ', PACK_DELTA, len(compressed)) + bytes.fromhex(base_id) + compressed
+    compressor = zlib.compressobj()
+    compressed = [compressor.compress(piece) for piece in object_chunks_gen(wit_directory, object_id)]
+    compressed.append(compressor.flush())
+    compressed = b"".join(compressed)
+    return struct.pack('>BQ', PACK_FULL, len(compressed)) + compressed
+
+
+def write_pack_index(index_path, offsets):
+    raw_ids = sorted(bytes.fromhex(object_id) for object_id in offsets)
+    fanout = [0] * 256
+    for raw_id in raw_ids:
+        fanout[raw_id[0]] += 1
+    for position in range(1, 256):
+        fanout[position] += fanout[position - 1]
+    index_data = b"".join((
+        PACK_INDEX_SIGNATURE,
+        struct.pack('>I', PACK_VERSION),
+        struct.pack('>256I', *fanout),
+        b"".join(raw_ids),
+        b"".join(struct.pack('>Q', offsets[raw_id.hex()]) for raw_id in raw_ids),
+    ))
+    save_object_file(index_path, lambda temp_path: temp_path.write_bytes(index_data), OBJECT_MODE)
+
+
+@traced('objects.pack')
+def make_pack(wit_directory, object_ids, delta_bases, pack_dir=None):
+    if pack_dir is None:
+        pack_dir = get_pack_dir(wit_directory)
+    pack_dir.mkdir(parents=True, exist_ok=True)
+    temp_fd, temp_name = tempfile.mkstemp(suffix='.tmp', dir=pack_dir)
+    pack_hash = hashlib.sha1()
+    offsets = {}
+    with os.fdopen(temp_fd, 'wb') as pack_file:
+        header = PACK_SIGNATURE + struct.pack('>II', PACK_VERSION, len(object_ids))
+        pack_file.write(header)
+        pack_hash.update(header)
+        position = len(header)
+        for start in range(0, len(object_ids), PACK_BATCH):
+            batch = object_ids[start:start + PACK_BATCH]
+            entries = map_jobs(
+                wit_directory,
+                lambda object_id: make_pack_entry(wit_directory, object_id, delta_bases.get(object_id)),
+                batch
+            )
+            for object_id, entry in zip(batch, entries):
+                offsets[object_id] = position
+                pack_file.write(entry)
+                pack_hash.update(entry)
+                position += len(entry)
+        pack_file.write(pack_hash.digest())
+
+    pack_path = pack_dir / f"pack-{pack_hash.hexdigest()}.pack"
+    os.chmod(temp_name, OBJECT_MODE)
+    os.replace(temp_name, pack_path)
+    write_pack_index(pack_path.with_suffix('.idx'), offsets)
+    return pack_path
+
+
+def repack():
+    working_directory = Path(os.getcwd())
+    wit_directory = get_wit_dir(working_directory, start_from_parent=False)
+    if wit_directory is None:
+        raise NoWitError("No wit folder found", working_directory)
+
+    loose_ids = set(loose_objects_gen(wit_directory))
+    old_packs = [pack[0] for pack in load_packs(wit_directory)]
+    object_ids = sorted(loose_ids | set(packed_objects_gen(wit_directory)))
+    if not object_ids:
+        print("no objects to pack")
+        return
+
+    delta_bases = find_delta_bases(wit_directory, set(object_ids))
+    pack_path = make_pack(wit_directory, object_ids, delta_bases)
+
+    for index_path in old_packs:
+        if index_path != pack_path.with_suffix('.idx'):
+            index_path.unlink(missing_ok=True)
+            index_path.with_suffix('.pack').unlink(missing_ok=True)
+    for object_id in loose_ids:
+        object_path = get_object_path(wit_directory, object_id)
+        object_path.unlink(missing_ok=True)
+        if not any(object_path.parent.iterdir()):
+            object_path.parent.rmdir()
+    PACKS.pop(get_pack_dir(wit_directory), None)
+    print(f"packed {len(object_ids)} objects ({len(delta_bases)} delta candidates) into {pack_path.name}")
+
+
+def gc():
+    working_directory = Path(os.getcwd())
+    wit_directory = get_wit_dir(working_directory, start_from_parent=False)
+    if wit_directory is None:
+        raise NoWitError("No wit folder found", working_directory)
+
+    objects_dir = get_common_folder(wit_directory) / 'objects'
+    for temp_path in objects_dir.glob('**/*.tmp'):
+        temp_path.unlink(missing_ok=True)
+    repack()
+
+
+def verify_loose_object(wit_directory, object_id):
+    try:
+        return hash_file(get_object_path(wit_directory, object_id)) == object_id
+    except OSError:
+        return False
+
+
+def verify_packed_object(wit_directory, object_id):
+    digest = hashlib.sha1()
+    try:
+        pack_map, offset = find_packed_object(wit_directory, object_id)
+        for piece in pack_entry_chunks_gen(wit_directory, pack_map, offset):
+            digest.update(piece)
+    except (ObjectError, OSError, ValueError, struct.error, zlib.error):
+        return False
+    return digest.hexdigest() == object_id
+
+
+def verify_pack(index_path):
+    pack_path = index_path.with_suffix('.pack')
+    digest = hashlib.sha1()
+    try:
+        with open(pack_path, 'rb') as pack_file:
+            size = os.fstat(pack_file.fileno()).st_size - 20
+            remaining = size
+            while remaining > 0:
+                data = pack_file.read(min(READ_CHUNK, remaining))
+                if not data:
+                    return False
+                digest.update(data)
+                remaining -= len(data)
+            return pack_file.read(20) == digest.digest()
+    except OSError:
+        return False
+
+
+def read_chunk_manifest(wit_directory, object_id):
+    head = b""
+    for piece in object_chunks_gen(wit_directory, object_id):
+        head += piece
+        if len(head) >= len(CHUNK_MAGIC):
+            break
+    if not head.startswith(CHUNK_MAGIC):
+        return None
+    manifest = read_object(wit_directory, object_id)
+    lines = manifest[len(CHUNK_MAGIC):].decode().splitlines()
+    return [(chunk_id, int(size)) for chunk_id, size in (line.split(" ", 1) for line in lines)]
+
+
+def get_chunk_ids(wit_directory, object_id):
+    return [chunk_id for chunk_id, _ in read_chunk_manifest(wit_directory, object_id) or []]
+
+
+def get_blob_size(wit_directory, object_id):
+    chunks = read_chunk_manifest(wit_directory, object_id)
+    if chunks is None:
+        return get_object_size(wit_directory, object_id)
+    return sum(size for _, size in chunks)
+
+
+def check_commit(wit_directory, commit_name, object_ids):
+    problems = []
+    commit_path = get_images_dir(wit_directory) / f"{commit_name}.txt"
+    if commit_name in object_ids and hashlib.sha1(commit_path.read_bytes()).hexdigest() != commit_name:
+        problems.append(f"corrupt commit {commit_name}")
+    for parent in read_commit_parents(wit_directory, commit_name):
+        if not commit_exists(get_images_dir(wit_directory) / parent):
+            problems.append(f"missing parent {parent} of commit {commit_name}")
+    tree_id = get_commit_tree(wit_directory, commit_name)
+    if tree_id is None:
+        problems.append(f"commit {commit_name} has no tree")
+    return problems, tree_id
+
+
+def check_tree(wit_directory, tree_id, object_ids):
+    problems = []
+    trees = []
+    blobs = []
+    for kind, object_id, name in read_tree(wit_directory, tree_id):
+        if object_id not in object_ids:
+            problems.append(f"missing {kind} {object_id} ({name}) in tree {tree_id}")
+        elif kind == 'tree':
+            trees.append(object_id)
+        else:
+            blobs.append(object_id)
+    return problems, trees, blobs
+
+
+def check_blob(wit_directory, object_id, object_ids):
+    try:
+        chunk_ids = get_chunk_ids(wit_directory, object_id)
+    except (ObjectError, OSError, ValueError, struct.error, zlib.error):
+        return [f"unreadable blob {object_id}"]
+    return [f"missing chunk {chunk_id} of blob {object_id}" for chunk_id in chunk_ids if chunk_id not in object_ids]
+
+
+def fsck():
+    working_directory = Path(os.getcwd())
+    wit_directory = get_wit_dir(working_directory, start_from_parent=False)
+    if wit_directory is None:
+        raise NoWitError("No wit folder found", working_directory)
+
+    problems = []
+    pack_paths = [pack[0] for pack in load_packs(wit_directory)]
+    for index_path, valid in zip(pack_paths, map_jobs(wit_directory, verify_pack, pack_paths)):
+        if not valid:
+            problems.append(f"corrupt pack {index_path.with_suffix('.pack').name}")
+
+    loose_ids = list(loose_objects_gen(wit_directory))
+    packed_ids = sorted(set(packed_objects_gen(wit_directory)))
+    checks = map_jobs(wit_directory, lambda object_id: verify_loose_object(wit_directory, object_id), loose_ids)
+    problems.extend(f"corrupt loose object {object_id}" for object_id, valid in zip(loose_ids, checks) if not valid)
+    checks = map_jobs(wit_directory, lambda object_id: verify_packed_object(wit_directory, object_id), packed_ids)
+    problems.extend(f"corrupt packed object {object_id}" for object_id, valid in zip(packed_ids, checks) if not valid)
+    object_ids = set(loose_ids) | set(packed_ids)
+
+    commit_names = sorted(path.stem for path in (get_images_dir(wit_directory)).glob('*.txt'))
+    tree_ids = set()
+    for commit_problems, tree_id in map_jobs(
+        wit_directory, lambda commit_name: check_commit(wit_directory, commit_name, object_ids), commit_names
+    ):
+        problems.extend(commit_problems)
+        if tree_id is not None:
+            tree_ids.add(tree_id)
+
+    seen_trees = set()
+    blob_ids = set()
+    pending = sorted(tree_ids)
+    while pending:
+        missing = [tree_id for tree_id in pending if tree_id not in object_ids]
+        problems.extend(f"missing tree {tree_id}" for tree_id in missing)
+        pending = [tree_id for tree_id in pending if tree_id in object_ids]
+        seen_trees.update(pending)
+        next_trees = set()
+        for tree_problems, trees, blobs in map_jobs(
+            wit_directory, lambda tree_id: check_tree(wit_directory, tree_id, object_ids), pending
+        ):
+            problems.extend(tree_problems)
+            next_trees.update(trees)
+            blob_ids.update(blobs)
+        pending = sorted(next_trees - seen_trees)
+
+    blob_list = sorted(blob_ids)
+    for blob_problems in map_jobs(
+        wit_directory, lambda object_id: check_blob(wit_directory, object_id, object_ids), blob_list
+    ):
+        problems.extend(blob_problems)
+
+    for problem in problems:
+        print(problem)
+    print(f"checked {len(object_ids)} objects, {len(commit_names)} commits: {len(problems)} problems")
+    if problems:
+        raise ObjectError("object store is corrupt", len(problems))
+
+
+IndexEntry = collections.namedtuple('IndexEntry', ['object_id', 'size', 'mtime_ns', 'ino'])
+
+
+def get_index_path(wit_directory):
+    return get_wit_folder(wit_directory) / 'index.txt'
+
+
+def make_index_entry(object_id, file_stat=None):
+    if file_stat is None:
+        return IndexEntry(object_id, -1, -1, -1)
+    return IndexEntry(object_id, file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino)
+
+
+def stat_matches(entry, file_stat):
+    return (
+        entry.size == file_stat.st_size
+        and entry.mtime_ns == file_stat.st_mtime_ns
+        and entry.ino == file_stat.st_ino
+    )
+
+
+def load_staging_area(wit_directory):
+    staging_area = get_wit_folder(wit_directory) / 'staging_area'
+    entries = {}
+    if staging_area.is_dir():
+        for dirpath, _, filenames in os.walk(staging_area):
+            for filename in filenames:
+                staging_file = Path(dirpath) / filename
+                name = staging_file.relative_to(staging_area).as_posix()
+                entries[name] = make_index_entry(write_blob(wit_directory, staging_file))
+        save_index(wit_directory, entries)
+        shutil.rmtree(staging_area, ignore_errors=True)
+    return entries
+
+
+@traced('index.load')
+def load_index(wit_directory):
+    index_path = get_index_path(wit_directory)
+    stat_key = get_stat_key(index_path)
+    if stat_key is None:
+        return load_staging_area(wit_directory)
+    cached = cache_get(INDEXES, index_path, stat_key)
+    if cached is not None:
+        return dict(cached)
+
+    entries = {}
+    with open(index_path, 'r') as index_file:
+        for line in index_file.read().splitlines():
+            object_id, size, mtime_ns, ino, name = line.split(" ", 4)
+            entries[name] = IndexEntry(object_id, int(size), int(mtime_ns), int(ino))
+    entries = mark_racy_entries(entries, stat_key[0])
+    cache_put(INDEXES, index_path, entries, PATH_CACHE_SIZE, stat_key)
+    return dict(entries)
+
+
+def mark_racy_entries(entries, index_time):
+    return {
+        name: entry._replace(mtime_ns=-1) if entry.mtime_ns >= index_time else entry
+        for name, entry in entries.items()
+    }
+
+
+@traced('index.save')
+def save_index(wit_directory, entries):
+    index_path = get_index_path(wit_directory)
+    entries = dict(sorted(entries.items()))
+    lines = [
+        f"{entry.object_id} {entry.size} {entry.mtime_ns} {entry.ino} {name}\n"
+        for name, entry in entries.items()
+    ]
+    temp_path = index_path.with_name(index_path.name + '.tmp')
+    with open(temp_path, 'w') as index_file:
+        index_file.write("".join(lines))
+    os.replace(temp_path, index_path)
+    stat_key = get_stat_key(index_path)
+    cache_put(INDEXES, index_path, mark_racy_entries(entries, stat_key[0]), PATH_CACHE_SIZE, stat_key)
+
+
+def check_index_entry(wit_directory, name, entry):
+    count('files_stat')
+    try:
+        file_stat = os.stat(os.path.join(wit_directory, name))
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    if not stat.S_ISREG(file_stat.st_mode):
+        return None
+    if stat_matches(entry, file_stat):
+        return entry
+    return make_index_entry(get_file_id(wit_directory, wit_directory / name), file_stat)
+
+
+def stage_file(wit_directory, name, entry):
+    wit_file = wit_directory / name
+    count('files_stat')
+    file_stat = wit_file.stat()
+    if entry is not None and stat_matches(entry, file_stat):
+        return entry
+    return make_index_entry(write_blob(wit_directory, wit_file), file_stat)
+
+
+def write_dict_tree(wit_directory, node):
+    lines = []
+    for name in sorted(node):
+        value = node[name]
+        if isinstance(value, dict):
+            if value:
+                lines.append(f"tree {write_dict_tree(wit_directory, value)} {name}\n")
+        elif isinstance(value, tuple):
+            lines.append(f"{value[0]} {value[1]} {name}\n")
+        else:
+            lines.append(f"blob {value} {name}\n")
+    return write_object(wit_directory, "".join(lines).encode())
+
+
+def get_sparse_path(wit_directory):
+    return get_wit_folder(wit_directory) / 'sparse-checkout'
+
+
+def load_sparse(wit_directory):
+    sparse_path = get_sparse_path(wit_directory)
+    if not sparse_path.is_file():
+        return ()
+    return tuple(line.strip().strip("/") for line in sparse_path.read_text().splitlines() if line.strip())
+
+
+def save_sparse(wit_directory, paths):
+    sparse_path = get_sparse_path(wit_directory)
+    paths = sorted({Path(path).as_posix().strip("/") for path in paths} - {"", "."})
+    if paths:
+        sparse_path.write_text("".join(f"{path}\n" for path in paths))
     else:
-        shutil.copy2(current_dir, new_dir)
+        sparse_path.unlink(missing_ok=True)
+    return tuple(paths)
 
 
-def get_from_references(wit_directory):
-    references = wit_directory / '.wit' / 'references.txt'
+def in_sparse(name, sparse):
+    return not sparse or any(name == path or name.startswith(path + "/") for path in sparse)
+
+
+def is_sparse_parent(name, sparse):
+    return any(path.startswith(name + "/") for path in sparse)
+
+
+def add_outside_sparse(wit_directory, node, tree_id, sparse, prefix=""):
+    for kind, object_id, name in read_tree(wit_directory, tree_id):
+        path = prefix + name
+        if in_sparse(path, sparse):
+            continue
+        if kind == 'tree' and is_sparse_parent(path, sparse):
+            add_outside_sparse(wit_directory, node.setdefault(name, {}), object_id, sparse, path + "/")
+        else:
+            node[name] = (kind, object_id)
+
+
+def expand_tree_value(wit_directory, value):
+    if isinstance(value, tuple) and value[0] == 'tree':
+        return {name: (kind, object_id) for kind, object_id, name in read_tree(wit_directory, value[1])}
+    return {}
+
+
+def write_files_tree(wit_directory, files, base_tree_id=None, sparse=()):
+    root = {}
+    if base_tree_id is not None and sparse:
+        add_outside_sparse(wit_directory, root, base_tree_id, sparse)
+    for name, object_id in files.items():
+        *dirnames, filename = name.split("/")
+        node = root
+        for dirname in dirnames:
+            child = node.get(dirname)
+            if not isinstance(child, dict):
+                child = expand_tree_value(wit_directory, child)
+                node[dirname] = child
+            node = child
+        node[filename] = object_id
+    return write_dict_tree(wit_directory, root)
+
+
+def write_index_tree(wit_directory, entries, base_tree_id=None, sparse=()):
+    files = {name: entry.object_id for name, entry in entries.items()}
+    return write_files_tree(wit_directory, files, base_tree_id, sparse)
+
+
+def ignore_pattern_regex(pattern):
+    dir_only = pattern.endswith("/")
+    pattern = pattern.rstrip("/")
+    anchored = "/" in pattern
+    pattern = pattern.lstrip("/")
+    regex = ""
+    position = 0
+    while position < len(pattern):
+        char = pattern[position]
+        if pattern.startswith("**/", position):
+            regex += "(?:.*/)?"
+            position += 3
+        elif pattern.startswith("**", position):
+            regex += ".*"
+            position += 2
+        elif char == "*":
+            regex += "[^/]*"
+            position += 1
+        elif char == "?":
+            regex += "[^/]"
+            position += 1
+        elif char == "[" and "]" in pattern[position + 2:]:
+            end = pattern.index("]", position + 2)
+            items = pattern[position + 1:end]
+            if items.startswith("!"):
+                items = "^" + items[1:]
+            regex += "[" + items.replace("\\", "\\\\") + "]"
+            position = end + 1
+        elif char == "\\" and position + 1 < len(pattern):
+            regex += re.escape(pattern[position + 1])
+            position += 2
+        else:
+            regex += re.escape(char)
+            position += 1
+    if not anchored:
+        regex = "(?:.*/)?" + regex
+    return regex + ("/" if dir_only else "/?")
+
+
+def compile_ignore_rules(text):
+    runs = []
+    for line in text.splitlines():
+        if not line.endswith("\\ "):
+            line = line.rstrip()
+        if not line or line.startswith("#"):
+            continue
+        negated = line.startswith("!")
+        if negated or line.startswith("\\!") or line.startswith("\\#"):
+            line = line[1:]
+        if line.strip("/") == "":
+            continue
+        if runs and runs[-1][0] == negated:
+            runs[-1][1].append(ignore_pattern_regex(line))
+        else:
+            runs.append((negated, [ignore_pattern_regex(line)]))
+    return [(negated, re.compile("|".join(f"(?:{regex})" for regex in regexes))) for negated, regexes in runs]
+
+
+def load_ignore_file(wit_directory, directory, rules):
+    ignore_path = directory / IGNORE_FILE
+    stat_key = get_stat_key(ignore_path)
+    if stat_key is None:
+        return rules
+    runs = cache_get(IGNORES, ignore_path, stat_key)
+    if runs is None:
+        runs = compile_ignore_rules(ignore_path.read_text(errors='replace'))
+        cache_put(IGNORES, ignore_path, runs, PATH_CACHE_SIZE, stat_key)
+    base = directory.relative_to(wit_directory).as_posix()
+    base = "" if base == "." else base + "/"
+    return rules + [(base, runs)]
+
+
+def is_ignored(rules, name, is_dir):
+    for base, runs in reversed(rules):
+        if not name.startswith(base):
+            continue
+        subject = name[len(base):] + ("/" if is_dir else "")
+        for negated, regex in reversed(runs):
+            if regex.fullmatch(subject):
+                return not negated
+    return False
+
+
+def get_ignore_rules(wit_directory, directory):
+    rules = []
+    for parent in reversed([directory, *directory.parents]):
+        if parent == wit_directory or wit_directory in parent.parents:
+            rules = load_ignore_file(wit_directory, parent, rules)
+    return rules
+
+
+def list_dir(dirpath):
+    stat_key = get_stat_key(dirpath)
+    if stat_key is None:
+        return [], []
+    stat_key = (stat_key[0], stat_key[2])
+    listing = cache_get(DIR_LISTINGS, dirpath, stat_key)
+    if listing is not None:
+        return listing
+    count('dirs_scanned')
+    dirnames = []
+    filenames = []
+    with os.scandir(dirpath) as entries:
+        for entry in entries:
+            if not entry.is_dir():
+                filenames.append(entry.name)
+            elif not entry.is_symlink():
+                dirnames.append(entry.name)
+    listing = (tuple(dirnames), tuple(filenames))
+    if stat_key[0] < time.time_ns() - LISTING_SETTLE_NS:
+        cache_put(DIR_LISTINGS, dirpath, listing, DIR_CACHE_SIZE, stat_key)
+    return listing
+
+
+def walk_dirs_gen(directory):
+    pending = [os.fspath(directory)]
+    while pending:
+        dirpath = pending.pop()
+        dirnames, filenames = list_dir(dirpath)
+        dirnames = list(dirnames)
+        yield dirpath, dirnames, filenames
+        pending.extend(os.path.join(dirpath, dirname) for dirname in reversed(dirnames))
+
+
+def working_dirs_gen(wit_directory, directory):
+    directory = Path(directory)
+    dir_rules = {os.fspath(directory): get_ignore_rules(wit_directory, directory)}
+    for dirpath, dirnames, filenames in walk_dirs_gen(directory):
+        rules = dir_rules.pop(dirpath)
+        if IGNORE_FILE in filenames and dirpath != os.fspath(directory):
+            rules = load_ignore_file(wit_directory, Path(dirpath), rules)
+        prefix = Path(dirpath).relative_to(wit_directory).as_posix()
+        prefix = "" if prefix == "." else prefix + "/"
+        dirnames[:] = sorted(
+            dirname for dirname in dirnames
+            if dirname != '.wit' and not is_ignored(rules, prefix + dirname, True)
+        )
+        for dirname in dirnames:
+            dir_rules[os.path.join(dirpath, dirname)] = rules
+        filenames = [
+            filename for filename in sorted(filenames)
+            if prefix + filename != '.wit' and not is_ignored(rules, prefix + filename, False)
+        ]
+        yield dirpath, prefix, rules, filenames
+
+
+def working_files_gen(wit_directory, directory):
+    for _, prefix, _, filenames in working_dirs_gen(wit_directory, directory):
+        for filename in filenames:
+            yield prefix + filename
+
+
+def get_lock_owner(lock_path):
+    try:
+        return int(lock_path.read_text())
+    except (OSError, ValueError):
+        return None
+
+
+def is_process_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+@contextlib.contextmanager
+def locked(path):
+    lock_path = path.with_name(path.name + '.lock')
+    deadline = time.monotonic() + LOCK_TIMEOUT
+    while True:
+        try:
+            lock_fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            owner = get_lock_owner(lock_path)
+            if owner is not None and not is_process_running(owner):
+                raise LockError(
+                    f"stale lock left by process {owner}, which is no longer running: remove the lock file", lock_path
+                )
+            if time.monotonic() > deadline:
+                raise LockError(
+                    f"could not acquire lock held by process {owner}: "
+                    "remove the lock file if no wit command is running", lock_path
+                )
+            time.sleep(0.01)
+    try:
+        os.write(lock_fd, str(os.getpid()).encode())
+        yield
+    finally:
+        os.close(lock_fd)
+        lock_path.unlink(missing_ok=True)
+
+
+def get_references_path(wit_directory):
+    return get_common_folder(wit_directory) / 'references.txt'
+
+
+def parse_reference(value):
+    value = value.strip()
+    if value == "True":
+        return True
+    elif value == "False":
+        return False
+    elif value == "None":
+        return None
+    return value
+
+
+def get_worktree_references_path(wit_directory):
+    wit_folder, common_folder = get_wit_folders(wit_directory)
+    if wit_folder == common_folder:
+        return None
+    return wit_folder / 'references.txt'
+
+
+def read_references(references):
+    stat_key = get_stat_key(references)
+    if stat_key is None:
+        return {}
+    cached = cache_get(REFERENCES, references, stat_key)
+    if cached is not None:
+        return cached
+
     branches = {}
-    if references.is_file():
-        with open(references, 'r') as ref_file:
-            ref_lines = ref_file.readlines()
-        for line in ref_lines:
-            branch_name, commit = line.split("=")
-            commit = commit.strip()
-            if commit == "True":
-                commit = True
-            elif commit == "False":
-                commit = False
-            elif commit == "None":
-                commit = None
-            branches[branch_name.strip()] = commit
+    with span('refs.load'), open(references, 'r') as ref_file:
+        for line in ref_file.read().splitlines():
+            if "=" in line:
+                branch_name, commit = line.split("=", 1)
+                branches[branch_name.strip()] = parse_reference(commit)
+    cache_put(REFERENCES, references, branches, PATH_CACHE_SIZE, stat_key)
     return branches
 
 
-def make_references(wit_directory, head, master, added):
-    references = wit_directory / '.wit' / 'references.txt'
-    append_text = ""
-    if references.is_file():
-        with open(references, 'r') as ref_file:
-            _ = [ref_file.readline().strip() for _ in range(3)]
-            append_text = ref_file.read()
-            
-    references_text = f"HEAD={head}\nmaster={master}\nadded={added}\n" + append_text
-    with open(references, 'w') as ref_file:
-        ref_file.write(references_text)
+def load_references(wit_directory):
+    branches = read_references(get_references_path(wit_directory))
+    worktree_references = get_worktree_references_path(wit_directory)
+    if worktree_references is None:
+        return branches
+    return {**branches, **read_references(worktree_references)}
+
+
+def get_from_references(wit_directory):
+    return dict(load_references(wit_directory))
+
+
+def write_references(references, changes, expected, fixed_names):
+    with locked(references):
+        REFERENCES.pop(references, None)
+        branches = dict(read_references(references))
+        if expected is not None and any(branches.get(name) != value for name, value in expected.items()):
+            raise BranchError("references changed while updating", sorted(expected))
+        branches.update(changes)
+        names = list(fixed_names) + [name for name in branches if name not in fixed_names]
+        references_text = "".join(f"{name}={branches.get(name)}\n" for name in names)
+        temp_path = references.with_name(references.name + '.tmp')
+        with open(temp_path, 'w') as ref_file:
+            ref_file.write(references_text)
+        os.replace(temp_path, references)
+    return branches
+
 
+@traced('refs.update')
+def update_references(wit_directory, changes, expected=None):
+    worktree_references = get_worktree_references_path(wit_directory)
+    if worktree_references is not None:
+        worktree_changes = {name: value for name, value in changes.items() if name in WORKTREE_REFERENCES}
+        changes = {name: value for name, value in changes.items() if name not in WORKTREE_REFERENCES}
+        if worktree_changes:
+            write_references(worktree_references, worktree_changes, None, WORKTREE_REFERENCES)
+        if not changes:
+            return
+    write_references(get_references_path(wit_directory), changes, expected, FIXED_REFERENCES)
 
-def add(path):
-    if ".wit" in path:
-        raise NoWitError("unauthorized path", path)
-    path = Path(path)
+
+def is_pathspec_glob(path):
+    return any(char in path for char in "*?[")
+
+
+def add(*paths, all_files=False):
     working_directory = Path(os.getcwd())
-    current_dir = working_directory / path
-    wit_directory = get_wit_dir(current_dir)
+    wit_directory = get_wit_dir(working_directory, start_from_parent=False)
     if wit_directory is None:
         raise NoWitError("No wit folder found", working_directory)
+    if all_files:
+        paths = (os.fspath(wit_directory),)
+    if not paths:
+        print("nothing specified, nothing added")
+        return
+
+    index = load_index(wit_directory)
+    added_files = set()
+    tracked = set()
+    patterns = []
+    for path in paths:
+        if '.wit' in Path(path).parts:
+            raise NoWitError("unauthorized path", path)
+        current_dir = working_directory / path
+        added_name = Path(os.path.relpath(current_dir, wit_directory)).as_posix()
+        if added_name == ".." or added_name.startswith("../"):
+            raise NoWitError("path is outside the repository", path)
+        if is_pathspec_glob(path) and not current_dir.exists():
+            patterns.append(fnmatch.translate(added_name))
+            continue
+
+        if added_name in index:
+            path_tracked = [added_name]
+        else:
+            prefix = "" if added_name == "." else added_name + "/"
+            path_tracked = [name for name in index if name.startswith(prefix)]
+
+        if current_dir.is_dir():
+            added_files.update(working_files_gen(wit_directory, current_dir))
+        elif current_dir.is_file():
+            added_files.add(added_name)
+        elif not path_tracked:
+            print(f"path does not exist: '{current_dir}'")
+            continue
+        tracked.update(path_tracked)
+
+    if patterns:
+        pathspec = re.compile("|".join(patterns))
+        for name in itertools.chain(working_files_gen(wit_directory, wit_directory), list(index)):
+            if pathspec.match(name):
+                if name in index:
+                    tracked.add(name)
+                else:
+                    added_files.add(name)
+
+    sparse = load_sparse(wit_directory)
+    if sparse:
+        outside = {name for name in added_files if not in_sparse(name, sparse)}
+        if outside:
+            print(f"skipped {len(outside)} paths outside the sparse checkout")
+            added_files -= outside
+
+    if not added_files and not tracked:
+        return
+    for name in tracked:
+        if (wit_directory / name).is_file():
+            added_files.add(name)
+        else:
+            del index[name]
+    added_names = sorted(added_files)
+    with span('copy.stage'):
+        staged = map_jobs(wit_directory, lambda name: stage_file(wit_directory, name, index.get(name)), added_names)
+    index.update(zip(added_names, staged))
+    save_index(wit_directory, index)
+
+    conflicts = load_merge_conflicts(wit_directory)
+    if conflicts.keys() & (added_files | tracked):
+        save_merge_conflicts(wit_directory, {
+            name: object_id for name, object_id in conflicts.items() if name not in added_files | tracked
+        })
+    update_references(wit_directory, {'added': True})
+
+
+def make_commit_text(head, message, tree_id):
+    date = datetime.datetime.now().ctime()
+    return f"tree={tree_id}\nparent={head}\ndate={date}\nmessage={message}"
 
-    staging_area = wit_directory / '.wit' / 'staging_area'
-    
-    current_dir_str = os.fspath(current_dir)
-    wit_dir_str = os.fspath(wit_directory)
-    added_path = current_dir_str.replace(wit_dir_str, "")
-    new_dir = os.fspath(staging_area) + added_path
-    new_dir = Path(new_dir)
-    new_dir.parent.mkdir(parents=True, exist_ok=True)
 
-    copy(current_dir, new_dir)
+def make_commit_id(wit_directory, commit_text):
+    commit_name = hashlib.sha1(commit_text.encode()).hexdigest()
+    return get_images_dir(wit_directory) / commit_name
 
-    ref = get_from_references(wit_directory)
 
-    head = ref.get('HEAD')
-    master = ref.get('master')
-    make_references(wit_directory, head, master, True)
+def make_commit_text_file(wit_directory, commit_id, commit_text):
+    commit_path = Path(os.fspath(commit_id) + ".txt")
+    if commit_path.is_file():
+        if commit_path.read_text() != commit_text:
+            raise CommitIdError("a different commit already has this id", commit_id.name)
+        return
+    write_object(wit_directory, commit_text.encode())
+    save_object_file(commit_path, lambda temp_path: temp_path.write_text(commit_text), OBJECT_MODE)
 
 
-def make_folder_name():
-    CHARACTERS = "1234567890abcdef"
-    folder_name_list = random.choices(CHARACTERS, k=40)
-    folder_name = "".join(folder_name_list)
-    return folder_name
+def commit_exists(commit_id):
+    return Path(os.fspath(commit_id) + ".txt").is_file()
 
 
-def make_commit_id(wit_directory):
-    folder_name = make_folder_name()
-    commit_id_dir = wit_directory / '.wit' / 'images' / folder_name
-    counter = 0
-    while commit_id_dir.exists() or counter == 10:
-        folder_name = make_folder_name()
-        commit_id_dir = wit_directory / '.wit' / 'images' / folder_name
-        counter += 1
-    if commit_id_dir.exists():
-        raise CommitIdError("not found a non existing name for commit_id folder", commit_id_dir)
-    return commit_id_dir
+def get_commit_info(commit_id):
+    commit_path = os.fspath(commit_id) + ".txt"
+    info = cache_get(COMMIT_INFOS, commit_path)
+    if info is not None:
+        return info
+    info = {}
+    with span('metadata.commit'), open(commit_path, 'r') as commit_file:
+        for line in commit_file.read().splitlines():
+            if "=" in line:
+                key, value = line.split("=", 1)
+                info.setdefault(key, value)
+    cache_put(COMMIT_INFOS, commit_path, info, COMMIT_CACHE_SIZE)
+    return info
 
 
-def change_branch(wit_directory, activated_branch, change_from, change_to):
-    references = wit_directory / '.wit' / 'references.txt'
-    old_text = f"{activated_branch}={change_from}"
-    new_text = f"{activated_branch}={change_to}"
-    with open(references, 'r') as ref_file:
-        ref_text = ref_file.read()
-    ref_text = ref_text.replace(old_text, new_text)
-    with open(references, 'w') as ref_file:
-        ref_file.write(ref_text)
+def get_commit_tree(wit_directory, commit_name):
+    commit_id = get_images_dir(wit_directory) / commit_name
+    if not commit_exists(commit_id):
+        raise CommitIdError("commit_id not found", commit_name)
+    tree_id = get_commit_info(commit_id).get('tree')
+    if tree_id is None and commit_id.is_dir():
+        tree_id = write_tree(wit_directory, commit_id)
+    return tree_id
 
 
-def make_commit_text_file(commit_id, head, message):
-    date = datetime.datetime.now().ctime()
-    commit_text = f"parent={head}\ndate={date}\nmessage={message}"
-    with open(os.fspath(commit_id) + ".txt", 'w') as commit_file:
-        commit_file.write(commit_text)
+def load_activated(wit_directory):
+    activated = get_wit_folder(wit_directory) / 'activated.txt'
+    stat_key = get_stat_key(activated)
+    if stat_key is None:
+        return None
+    activated_branch = cache_get(ACTIVATED, activated, stat_key)
+    if activated_branch is None:
+        activated_branch = activated.read_text()
+        cache_put(ACTIVATED, activated, activated_branch, PATH_CACHE_SIZE, stat_key)
+    return activated_branch
+
+
+def save_activated(wit_directory, branch_name):
+    activated = get_wit_folder(wit_directory) / 'activated.txt'
+    temp_path = activated.with_name(activated.name + '.tmp')
+    temp_path.write_text(branch_name)
+    os.replace(temp_path, activated)
+
+
+def save_commit(wit_directory, tree_id, message, parent2=None):
+    activated_branch = load_activated(wit_directory)
+    if activated_branch is None:
+        raise FileNotFoundError("activated file not found", get_wit_folder(wit_directory) / 'activated.txt')
+
+    ref = get_from_references(wit_directory)
+    head = ref.get('HEAD')
+    merge_head = get_wit_folder(wit_directory) / 'merge_head.txt'
+    if parent2 is None and merge_head.is_file():
+        parent2 = merge_head.read_text()
+
+    if parent2:
+        commit_text = make_commit_text(head + f",{parent2}", message, tree_id)
+    else:
+        commit_text = make_commit_text(head, message, tree_id)
+    commit_id = make_commit_id(wit_directory, commit_text)
+    make_commit_text_file(wit_directory, commit_id, commit_text)
+    get_commit_node(wit_directory, commit_id.name)
+
+    changes = {'HEAD': commit_id.name, 'added': False}
+    if ref.get(activated_branch) == head:
+        changes[activated_branch] = commit_id.name
+    update_references(wit_directory, changes)
+    merge_head.unlink(missing_ok=True)
+    save_merge_conflicts(wit_directory, {})
+    return commit_id.name
 
 
 def commit(message, parent2=None):
@@ -188,123 +1739,326 @@ def commit(message, parent2=None):
     if wit_directory is None:
         raise NoWitError("No wit folder found", working_directory)
 
-    activated = wit_directory / '.wit' / 'activated.txt'
     ref = get_from_references(wit_directory)
-
     added = ref.get('added') is True
     head = ref.get('HEAD')
-    master = ref.get('master')
 
     if not added:
         print("There was no change in the files")
     else:
-        if not activated.is_file():
-            raise FileNotFoundError("activated file not found", activated)
-        with open(activated, 'r') as act_file:
-            activated_branch = act_file.read()
-        
-        commit_id = make_commit_id(wit_directory)
+        index = load_index(wit_directory)
+        unresolved = get_unresolved_conflicts(wit_directory, index)
+        if unresolved:
+            raise MergeError("fix the merge conflicts and add the files before committing", unresolved[0])
+        sparse = load_sparse(wit_directory)
+        head_tree = get_commit_tree(wit_directory, head) if head and sparse else None
+        with span('objects.tree'):
+            tree_id = write_index_tree(wit_directory, index, head_tree, sparse)
+        save_commit(wit_directory, tree_id, message, parent2)
+
+
+def get_head_files(wit_directory, head, sparse=()):
+    if head is None:
+        return {}
+    return tree_files(wit_directory, get_commit_tree(wit_directory, head), sparse=sparse)
+
+
+TreeDiff = collections.namedtuple('TreeDiff', ['staged', 'modified', 'untracked', 'deleted'])
+
+
+def get_staged(index, commit_files):
+    staged = [name for name, entry in index.items() if commit_files.get(name) != entry.object_id]
+    staged.extend(name for name in commit_files if name not in index)
+    return sorted(staged)
+
+
+def check_entries(wit_directory, index, names):
+    modified = []
+    deleted = []
+    checked = map_jobs(wit_directory, lambda name: check_index_entry(wit_directory, name, index[name]), names)
+    for name, new_entry in zip(names, checked):
+        if new_entry is None:
+            deleted.append(name)
+        elif new_entry.object_id != index[name].object_id:
+            modified.append(name)
+        elif new_entry != index[name]:
+            index[name] = new_entry
+    return modified, deleted
+
+
+def diff_tree(wit_directory, index, commit_files):
+    untracked = [name for name in working_files_gen(wit_directory, wit_directory) if name not in index]
+    modified, deleted = check_entries(wit_directory, index, sorted(index))
+    return TreeDiff(get_staged(index, commit_files), modified, untracked, deleted)
+
+
+def diff_tree_monitored(wit_directory, index, commit_files, state, dirty):
+    dirty_dirs = tuple(name for name in dirty if name.endswith("/"))
+    dirty_files = {name for name in dirty if not name.endswith("/")}
+
+    def is_dirty(name):
+        return name in dirty_files or name.startswith(dirty_dirs)
+
+    unclean = set(state.modified) | set(state.deleted)
+    to_check = sorted(
+        name for name, entry in index.items()
+        if name in unclean or entry.size == -1 or entry.mtime_ns == -1 or is_dirty(name)
+    )
+    modified, deleted = check_entries(wit_directory, index, to_check)
+
+    untracked = {name for name in state.untracked if name not in index and not is_dirty(name)}
+    untracked.update(
+        name for name in dirty_files if name not in index and (wit_directory / name).is_file()
+    )
+    return TreeDiff(get_staged(index, commit_files), modified, sorted(untracked), deleted)
+
+
+def load_fsmonitor_state(wit_directory):
+    state_path = get_wit_folder(wit_directory) / FSMONITOR_STATE
+    if not state_path.is_file():
+        return "", TreeDiff([], [], [], [])
+    state = {'modified': [], 'deleted': [], 'untracked': []}
+    token, *lines = state_path.read_text().splitlines()
+    for line in lines:
+        kind, name = line.split(" ", 1)
+        state[kind].append(name)
+    return token, TreeDiff([], state['modified'], state['untracked'], state['deleted'])
+
+
+def save_fsmonitor_state(wit_directory, token, tree_diff):
+    lines = [token]
+    lines.extend(f"modified {name}" for name in tree_diff.modified)
+    lines.extend(f"deleted {name}" for name in tree_diff.deleted)
+    lines.extend(f"untracked {name}" for name in tree_diff.untracked)
+    state_path = get_wit_folder(wit_directory) / FSMONITOR_STATE
+    save_object_file(state_path, lambda temp_path: temp_path.write_text("\n".join(lines) + "\n"))
+
+
+def query_fsmonitor(wit_directory, request):
+    socket_path = get_wit_folder(wit_directory) / FSMONITOR_SOCKET
+    if not socket_path.exists():
+        return None
+    chunks = []
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.settimeout(FSMONITOR_TIMEOUT)
+            client.connect(os.fspath(socket_path))
+            client.sendall(f"{request}\n".encode())
+            while True:
+                data = client.recv(READ_CHUNK)
+                if not data:
+                    break
+                chunks.append(data)
+    except OSError:
+        return None
+    lines = b"".join(chunks).decode().split("\n")[:-1]
+    if len(lines) < 2:
+        return None
+    return lines[0], None if lines[1] == 'full' else lines[2:]
 
-        if ref.get(activated_branch) == head:
-            change_branch(wit_directory, activated_branch, head, commit_id.name)
 
-        if (head == master) and (activated_branch == 'master'):
-            make_references(wit_directory, commit_id.name, commit_id.name, False)
+def watch_tree(monitor, directory):
+    names = []
+    for dirpath, prefix, rules, filenames in working_dirs_gen(monitor['wit_directory'], directory):
+        wd = monitor['libc'].inotify_add_watch(monitor['fd'], os.fsencode(dirpath), INOTIFY_MASK)
+        if wd >= 0:
+            monitor['watches'][wd] = (prefix, rules)
+        names.append(prefix)
+        names.extend(prefix + filename for filename in filenames)
+    return names
+
+
+def start_fsmonitor(monitor):
+    import ctypes
+
+    if monitor['fd'] is not None:
+        os.close(monitor['fd'])
+    fd = monitor['libc'].inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    if fd < 0:
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error))
+    monitor.update(fd=fd, watches={}, changed={}, sequence=0, instance=os.urandom(8).hex())
+    watch_tree(monitor, monitor['wit_directory'])
+    wit_path = os.fsencode(get_wit_folder(monitor['wit_directory']))
+    monitor['cookie_watch'] = monitor['libc'].inotify_add_watch(fd, wit_path, IN_CREATE)
+
+
+def mark_changed(monitor, names):
+    for name in names:
+        monitor['sequence'] += 1
+        monitor['changed'][name] = monitor['sequence']
+
+
+def read_inotify_events(monitor):
+    events = []
+    while True:
+        try:
+            data = os.read(monitor['fd'], 1 << 16)
+        except BlockingIOError:
+            return events
+        position = 0
+        while position < len(data):
+            wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, position)
+            position += INOTIFY_EVENT.size
+            name = os.fsdecode(data[position:position + length].rstrip(b"\0"))
+            position += length
+            events.append((wd, mask, name))
+
+
+def handle_inotify_events(monitor, events):
+    cookies = []
+    for wd, mask, name in events:
+        if mask & IN_Q_OVERFLOW:
+            start_fsmonitor(monitor)
+            return cookies
+        if wd == monitor['cookie_watch']:
+            if name.startswith(FSMONITOR_COOKIE):
+                cookies.append(name)
+            continue
+        if mask & IN_IGNORED:
+            monitor['watches'].pop(wd, None)
+            continue
+        watch = monitor['watches'].get(wd)
+        if watch is None or not name:
+            continue
+        prefix, rules = watch
+        is_dir = bool(mask & IN_ISDIR)
+        if prefix + name == '.wit' or is_ignored(rules, prefix + name, is_dir):
+            continue
+        if name == IGNORE_FILE:
+            start_fsmonitor(monitor)
+            return cookies
+        if is_dir and mask & (IN_CREATE | IN_MOVED_TO):
+            mark_changed(monitor, watch_tree(monitor, monitor['wit_directory'] / (prefix + name)))
+        elif is_dir:
+            mark_changed(monitor, [prefix + name + "/"])
         else:
-            make_references(wit_directory, commit_id.name, head, False)
-        
-        if parent2:
-            make_commit_text_file(commit_id, head + f",{parent2}", message)
+            mark_changed(monitor, [prefix + name])
+    return cookies
+
+
+def read_fsmonitor_request(connection):
+    connection.settimeout(FSMONITOR_TIMEOUT)
+    data = b""
+    try:
+        while b"\n" not in data:
+            chunk = connection.recv(READ_CHUNK)
+            if not chunk:
+                break
+            data += chunk
+    except OSError:
+        pass
+    return data.split(b"\n", 1)[0].decode(errors='replace')
+
+
+def answer_fsmonitor_query(monitor, connection, request):
+    instance, _, sequence = request.partition(":")
+    lines = [f"{monitor['instance']}:{monitor['sequence']}"]
+    if instance != monitor['instance'] or not sequence.isdigit():
+        lines.append('full')
+    else:
+        since = int(sequence)
+        lines.append('partial')
+        lines.extend(name for name, number in monitor['changed'].items() if number > since)
+    try:
+        connection.sendall(("\n".join(lines) + "\n").encode())
+    except OSError:
+        pass
+    finally:
+        connection.close()
+
+
+def daemon(stop=False):
+    import ctypes
+
+    working_directory = Path(os.getcwd())
+    wit_directory = get_wit_dir(working_directory, start_from_parent=False)
+    if wit_directory is None:
+        raise NoWitError("No wit folder found", working_directory)
+
+    if stop:
+        if query_fsmonitor(wit_directory, 'stop') is None:
+            print("fsmonitor is not running")
         else:
-            make_commit_text_file(commit_id, head, message)
-
-        staging_area_dir = wit_directory / '.wit' / 'staging_area'
-        shutil.copytree(staging_area_dir, commit_id)
-
-
-def deep_comper(comp_obj):
-    sub_comps_names = comp_obj.common_dirs
-    for name in sub_comps_names:
-        yield comp_obj.subdirs[name]
-        new_comps = deep_comper(comp_obj.subdirs[name])
-        for comp in new_comps:
-            yield comp
-
-
-def to_be_committed_gen(staging_area, commit_id, wit_directory):
-    wit_path = os.fspath(wit_directory)
-    staging_path = os.fspath(staging_area)
-
-    staging_to_commit = filecmp.dircmp(staging_area, commit_id)
-    for name in staging_to_commit.left_only:
-        file_path = wit_directory / name
-        yield file_path
-    for name in staging_to_commit.diff_files:
-        file_path = wit_directory / name
-        yield file_path
-    sub_compers = deep_comper(staging_to_commit)
-    for comp in sub_compers:
-        for diff in comp.diff_files:
-            path = Path(comp.left) / diff
-            path = os.fspath(path)
-            file_path = path.replace(staging_path, wit_path)
-            yield Path(file_path)
-        for name in comp.left_only:
-            path = Path(comp.left) / name
-            path = os.fspath(path)
-            file_path = path.replace(staging_path, wit_path)
-            yield Path(file_path)
-
-
-def not_staged_gen(wit_directory, staging_area):
-    wit_path = os.fspath(wit_directory)
-    staging_path = os.fspath(staging_area)
-
-    witdir_to_staging = filecmp.dircmp(wit_directory, staging_area, ignore=['.wit'])
-    for name in witdir_to_staging.diff_files:
-        file_path = wit_directory / name
-        yield file_path
-    sub_compers = deep_comper(witdir_to_staging)
-    for comp in sub_compers:
-        for name in comp.diff_files:
-            path = Path(comp.right) / name
-            path = os.fspath(path)
-            file_path = path.replace(staging_path, wit_path)
-            yield Path(file_path)
-
-
-def untracked_gen(wit_directory, staging_area):
-    wit_path = os.fspath(wit_directory)
-    staging_path = os.fspath(staging_area)
-
-    witdir_to_staging = filecmp.dircmp(wit_directory, staging_area, ignore=['.wit'])
-    for name in witdir_to_staging.left_only:
-        file_path = wit_directory / name
-        yield file_path
-    sub_compers = deep_comper(witdir_to_staging)
-    for comp in sub_compers:
-        for name in comp.left_only:
-            path = Path(comp.right) / name
-            path = os.fspath(path)
-            file_path = path.replace(staging_path, wit_path)
-            yield Path(file_path)
-
-
-def staging_files_gen(staging_area, wit_directory):
-    wit_path = os.fspath(wit_directory)
-    staging_path = os.fspath(staging_area)
-
-    for dirpath, dirnames, filenames in os.walk(staging_area):
-        for filename in filenames:
-            path = Path(dirpath) / filename
-            path = os.fspath(path)
-            file_path = path.replace(staging_path, wit_path)
-            yield file_path
-        for dirname in dirnames:
-            path = Path(dirpath) / dirname
-            path = os.fspath(path)
-            file_path = path.replace(staging_path, wit_path)
-            yield file_path 
+            print("fsmonitor stopped")
+        return
+    if query_fsmonitor(wit_directory, 'ping') is not None:
+        print("fsmonitor is already running")
+        return
+
+    socket_path = get_wit_folder(wit_directory) / FSMONITOR_SOCKET
+    socket_path.unlink(missing_ok=True)
+    monitor = {'wit_directory': wit_directory, 'libc': ctypes.CDLL(None, use_errno=True), 'fd': None}
+    start_fsmonitor(monitor)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    pending = {}
+    cookie_number = 0
+    try:
+        server.bind(os.fspath(socket_path))
+        server.listen()
+        print(f"fsmonitor watching {wit_directory}")
+        while True:
+            readable, _, _ = select.select([server, monitor['fd']], [], [])
+            if monitor['fd'] in readable:
+                instance = monitor['instance']
+                cookies = handle_inotify_events(monitor, read_inotify_events(monitor))
+                if monitor['instance'] != instance:
+                    cookies = list(pending)
+                for cookie in cookies:
+                    if cookie in pending:
+                        answer_fsmonitor_query(monitor, *pending.pop(cookie))
+                        (get_wit_folder(wit_directory) / cookie).unlink(missing_ok=True)
+            if server in readable:
+                connection, _ = server.accept()
+                request = read_fsmonitor_request(connection)
+                if request == 'stop':
+                    answer_fsmonitor_query(monitor, connection, request)
+                    break
+                cookie_number += 1
+                cookie = f"{FSMONITOR_COOKIE}{cookie_number}"
+                pending[cookie] = (connection, request)
+                (get_wit_folder(wit_directory) / cookie).touch()
+    finally:
+        server.close()
+        socket_path.unlink(missing_ok=True)
+        os.close(monitor['fd'])
+        for cookie, (connection, _) in pending.items():
+            connection.close()
+            (get_wit_folder(wit_directory) / cookie).unlink(missing_ok=True)
+
+
+@traced('diff.status')
+def get_tree_diff(wit_directory):
+    ref = get_from_references(wit_directory)
+    index = load_index(wit_directory)
+    loaded_index = dict(index)
+    commit_files = get_head_files(wit_directory, ref.get('HEAD'), load_sparse(wit_directory))
+    token, state = load_fsmonitor_state(wit_directory)
+    response = query_fsmonitor(wit_directory, token)
+    if response is None or response[1] is None:
+        tree_diff = diff_tree(wit_directory, index, commit_files)
+    else:
+        tree_diff = diff_tree_monitored(wit_directory, index, commit_files, state, response[1])
+    if response is not None:
+        save_fsmonitor_state(wit_directory, response[0], tree_diff)
+    if index != loaded_index:
+        save_index(wit_directory, index)
+    return tree_diff
+
+
+def to_be_committed_gen(tree_diff, wit_directory):
+    for name in tree_diff.staged:
+        yield wit_directory / name
+
+
+def not_staged_gen(tree_diff, wit_directory):
+    for name in tree_diff.modified + tree_diff.deleted:
+        yield wit_directory / name
+
+
+def untracked_gen(tree_diff, wit_directory):
+    for name in tree_diff.untracked:
+        yield wit_directory / name
 
 
 def status():
@@ -313,130 +2067,150 @@ def status():
     if wit_directory is None:
         raise NoWitError("No wit folder found", working_directory)
 
-    staging_area = wit_directory / '.wit' / 'staging_area'
-
     ref = get_from_references(wit_directory)
+    tree_diff = get_tree_diff(wit_directory)
 
     commit_id_name = ref.get('HEAD')
     print(f"commit id: {commit_id_name}")
     print('-' * 40)
     
     print("Changes to be committed:\n")
-    if commit_id_name:
-        commit_id = wit_directory / '.wit' / 'images' / commit_id_name
-        to_be_committed = to_be_committed_gen(staging_area, commit_id, wit_directory)
-    else:
-        to_be_committed = staging_files_gen(staging_area, wit_directory)
+    to_be_committed = to_be_committed_gen(tree_diff, wit_directory)
     for file_path in to_be_committed:
         print(file_path)
     print('-' * 40)
 
     print("Changes not staged for commit:\n")
-    not_staged_for_commit = not_staged_gen(wit_directory, staging_area)
+    not_staged_for_commit = not_staged_gen(tree_diff, wit_directory)
     for f in not_staged_for_commit:
         print(f)
     print('-' * 40)
 
     print("Untracked files:\n")
-    untracked = untracked_gen(wit_directory, staging_area)
+    untracked = untracked_gen(tree_diff, wit_directory)
     for f in untracked:
         print(f)
     print('-' * 40)
 
 
-def check_status(wit_directory, staging_area):
-    ref = get_from_references(wit_directory)
-    commit_id_name = ref.get('HEAD')
+def check_status(tree_diff):
+    return not (tree_diff.staged or tree_diff.modified or tree_diff.deleted)
 
-    to_be_committed = None
-    if commit_id_name:
-        commit_id = wit_directory / '.wit' / 'images' / commit_id_name
-        to_be_committed = to_be_committed_gen(staging_area, commit_id, wit_directory)
-    else:
-        to_be_committed = staging_files_gen(staging_area, wit_directory)
-    
-    not_staged_for_commit = not_staged_gen(wit_directory, staging_area)
-
-    to_be_committed_empty = len(list(to_be_committed)) == 0
-    not_staged_empty = len(list(not_staged_for_commit)) == 0
-
-    return to_be_committed_empty and not_staged_empty
 
+def remove_working_file(wit_directory, name):
+    wit_file = wit_directory / name
+    wit_file.unlink(missing_ok=True)
+    for parent in wit_file.parents:
+        if parent == wit_directory or (parent.is_dir() and any(parent.iterdir())):
+            break
+        if parent.is_dir():
+            parent.rmdir()
 
-def make_checkout(commit_id, wit_directory, untracked_list):
-    commit_dir = os.fspath(commit_id)
-    wit_dir = os.fspath(wit_directory)
-    files_in_commit = []
 
-    for dirpath, _, filenames in os.walk(commit_id):
-        for filename in filenames:
-            commit_file = Path(dirpath) / filename
-            commit_file_str = os.fspath(commit_file)
-            wit_file = commit_file_str.replace(commit_dir, wit_dir)
-            wit_file = Path(wit_file)
-            files_in_commit.append(wit_file)
-            if wit_file not in untracked_list:
-                shutil.copy2(commit_file, wit_file)
-
-    for dirpath, _, filenames in os.walk(wit_directory):
-        for filename in filenames:
-            wit_file = Path(dirpath) / filename
-            if ".wit" not in os.fspath(wit_file):
-                if (wit_file not in files_in_commit) and (wit_file not in untracked_list):
-                    wit_file.unlink()
+def checkout_file(wit_directory, name, object_id):
+    wit_file = wit_directory / name
+    if wit_file.is_dir() and not wit_file.is_symlink():
+        if any(wit_file.iterdir()):
+            raise CheckoutError("untracked files are in the way", name)
+        wit_file.rmdir()
+    else:
+        wit_file.unlink(missing_ok=True)
+    try:
+        copy_blob(wit_directory, object_id, wit_file)
+    except (FileExistsError, NotADirectoryError) as error:
+        raise CheckoutError("an untracked file is in the way", name) from error
+    file_stat = wit_file.stat()
+    count('files_written')
+    count('bytes_written', file_stat.st_size)
+    return make_index_entry(object_id, file_stat)
+
+
+@traced('copy.checkout')
+def make_checkout(commit_files, wit_directory, index, tree_diff):
+    untracked = set(tree_diff.untracked)
+    dirty = set(tree_diff.modified + tree_diff.deleted)
+    new_index = {}
+    to_write = []
+    for name, object_id in commit_files.items():
+        entry = index.get(name)
+        if entry is not None and entry.object_id == object_id and name not in dirty:
+            new_index[name] = entry
+        else:
+            to_write.append((name, object_id))
+
+    untracked_dirs = {name[:end] for name in untracked for end, char in enumerate(name) if char == "/"}
+    for name, _ in to_write:
+        if name in untracked or name in untracked_dirs:
+            raise CheckoutError("untracked files are in the way", name)
+        if any(char == "/" and name[:end] in untracked for end, char in enumerate(name)):
+            raise CheckoutError("untracked files are in the way", name)
+
+    for name in index:
+        if name not in commit_files:
+            remove_working_file(wit_directory, name)
+
+    written = map_jobs(wit_directory, lambda item: checkout_file(wit_directory, *item), to_write)
+    new_index.update((name, entry) for (name, _), entry in zip(to_write, written))
+    return new_index
     
 
-def checkout(name, check_stat=True):
+def checkout(name=None, check_stat=True, sparse=None):
     working_directory = Path(os.getcwd())
     wit_directory = get_wit_dir(working_directory, start_from_parent=False)
     if wit_directory is None:
         raise NoWitError("No wit folder found", working_directory)
 
-    staging_area = wit_directory / '.wit' / 'staging_area'
-    activated = wit_directory / '.wit' / 'activated.txt'
-
     ref = get_from_references(wit_directory)
-    master = ref.get('master')
-
-    branch = ref.get(name)
+    if name is None:
+        name = ref.get('HEAD')
+        branch = None
+        if name is None:
+            raise CheckoutError("no commit to check out")
+    else:
+        branch = ref.get(name)
 
     if branch:
         commit_id_name = branch
+        tracked_branch = get_tracked_branch(wit_directory, name)
+        if tracked_branch is not None and ref.get(tracked_branch) in (None, branch):
+            name = tracked_branch
+        elif tracked_branch is not None:
+            branch = None
+        if branch and name in checked_out_branches(wit_directory, exclude=wit_directory):
+            raise CheckoutError("branch is checked out in another worktree", name)
     else:
         commit_id_name = name
 
-    commit_id = wit_directory / '.wit' / 'images' / commit_id_name
-    if not commit_id.is_dir():
+    commit_id = get_images_dir(wit_directory) / commit_id_name
+    if not commit_exists(commit_id):
         raise CheckoutError("commit_id or branch not found", name)
+    commit_tree = get_commit_tree(wit_directory, commit_id_name)
 
-    if not check_status(wit_directory, staging_area) and check_stat:
+    tree_diff = get_tree_diff(wit_directory)
+    if check_stat and not check_status(tree_diff):
         raise DataNotSaved()
-    untracked = untracked_gen(wit_directory, staging_area)
-    untracked_list = list(untracked)
-    make_checkout(commit_id, wit_directory, untracked_list)
-    make_references(wit_directory, commit_id.name, master, False)
-
-    copy(commit_id, staging_area)
+    if sparse is None:
+        sparse = load_sparse(wit_directory)
+    else:
+        sparse = save_sparse(wit_directory, sparse)
+    commit_files = tree_files(wit_directory, commit_tree, sparse=sparse)
+    index = make_checkout(commit_files, wit_directory, load_index(wit_directory), tree_diff)
+    update_references(wit_directory, {'HEAD': commit_id.name, 'added': False})
+
+    save_index(wit_directory, index)
+    (get_wit_folder(wit_directory) / 'merge_head.txt').unlink(missing_ok=True)
+    save_merge_conflicts(wit_directory, {})
     if branch:
-        with open(activated, 'w') as activated_branch:
-            activated_branch.write(name)
+        if ref.get(name) != branch:
+            update_references(wit_directory, {name: branch}, expected={name: ref.get(name)})
+        save_activated(wit_directory, name)
 
 
 def get_parent(folder_dir):
-    if not folder_dir.is_dir():
+    if not commit_exists(folder_dir):
         return None
-    file_dir = os.fspath(folder_dir) + ".txt"
-    file_dir = Path(file_dir)
-    if not file_dir.is_file():
-        return None
-
-    parent = None
-    with open(file_dir, 'r') as f:
-        f_lines = f.readlines()
-    for line in f_lines:
-        if "parent=" in line:
-            parent = line.replace("parent=", "").strip()
-    if parent == "None":
+    parent = get_commit_info(folder_dir).get('parent')
+    if parent is None or parent == "None":
         return None
     elif "," in parent:
         return parent.split(",")
@@ -444,32 +2218,507 @@ def get_parent(folder_dir):
         return parent
 
 
-def get_parents(wit_directory, head):
-    parents = {}
-    head_dir = wit_directory / '.wit' / 'images' / head
-    parent = get_parent(head_dir)
-    while parent is not None:
-        parents[head] = parent
-        if type(parent) is list:
-            head = parent[0]
-        else:
-            head = parent
-        head_dir = wit_directory / '.wit' / 'images' / head
-        parent = get_parent(head_dir)
-    return parents
+CommitNode = collections.namedtuple('CommitNode', ['parents', 'generation'])
+
+
+def get_commit_graph_path(wit_directory):
+    return get_common_folder(wit_directory) / 'commit-graph'
+
+
+def load_commit_graph(wit_directory):
+    graph_path = get_commit_graph_path(wit_directory)
+    stat_key = get_stat_key(graph_path)
+    if stat_key is None:
+        return {}
+    graph_size, graph_ino = stat_key[1], stat_key[2]
+    header_size = len(COMMIT_GRAPH_SIGNATURE) + 4
+    cached = COMMIT_GRAPHS.get(graph_path)
+    if cached is not None and cached[0] != graph_ino:
+        cached = None
+
+    with span('metadata.graph'), open(graph_path, 'rb') as graph_file:
+        if cached is not None:
+            _, loaded_size, last_record, nodes = cached
+            graph_file.seek(loaded_size - len(last_record))
+            if loaded_size > graph_size or graph_file.read(len(last_record)) != last_record:
+                cached = None
+            elif loaded_size == graph_size:
+                return nodes
+        if cached is None:
+            loaded_size, last_record, nodes = header_size, b"", {}
+        graph_file.seek(0)
+        if graph_file.read(len(COMMIT_GRAPH_SIGNATURE)) != COMMIT_GRAPH_SIGNATURE:
+            raise CommitIdError("invalid commit-graph file", graph_path)
+        graph_file.seek(loaded_size)
+        data = graph_file.read(graph_size - loaded_size)
+
+    records_size = len(data) - len(data) % COMMIT_GRAPH_RECORD.size
+    for offset in range(0, records_size, COMMIT_GRAPH_RECORD.size):
+        commit_id, parent1, parent2, generation = COMMIT_GRAPH_RECORD.unpack_from(data, offset)
+        parents = tuple(parent.hex() for parent in (parent1, parent2) if parent != NO_PARENT)
+        nodes[commit_id.hex()] = CommitNode(parents, generation)
+    if records_size:
+        last_record = data[records_size - COMMIT_GRAPH_RECORD.size:records_size]
+    COMMIT_GRAPHS[graph_path] = (graph_ino, loaded_size + records_size, last_record, nodes)
+    return nodes
+
+
+def append_commit_graph(wit_directory, new_nodes):
+    graph_path = get_commit_graph_path(wit_directory)
+    records = []
+    for commit_id, node in new_nodes.items():
+        raw_parents = [bytes.fromhex(parent) for parent in node.parents] + [NO_PARENT, NO_PARENT]
+        records.append(COMMIT_GRAPH_RECORD.pack(
+            bytes.fromhex(commit_id), raw_parents[0], raw_parents[1], node.generation
+        ))
+    with locked(graph_path), open(graph_path, 'ab') as graph_file:
+        if graph_file.tell() == 0:
+            graph_file.write(COMMIT_GRAPH_SIGNATURE + struct.pack('>I', COMMIT_GRAPH_VERSION))
+        graph_file.write(b"".join(records))
+
+
+def get_shallow_path(wit_directory):
+    return get_common_folder(wit_directory) / 'shallow'
+
+
+def load_shallow(wit_directory):
+    shallow_path = get_shallow_path(wit_directory)
+    try:
+        shallow_time = shallow_path.stat().st_mtime_ns
+    except FileNotFoundError:
+        return frozenset()
+    cached = SHALLOWS.get(shallow_path)
+    if cached is not None and cached[0] == shallow_time:
+        return cached[1]
+    commits = frozenset(line.strip() for line in shallow_path.read_text().splitlines() if line.strip())
+    SHALLOWS[shallow_path] = (shallow_time, commits)
+    return commits
+
+
+def save_shallow(wit_directory, commits):
+    shallow_path = get_shallow_path(wit_directory)
+    if commits:
+        shallow_path.write_text("".join(f"{commit_id}\n" for commit_id in sorted(commits)))
+    else:
+        shallow_path.unlink(missing_ok=True)
+    graph_path = get_commit_graph_path(wit_directory)
+    graph_path.unlink(missing_ok=True)
+    COMMIT_GRAPHS.pop(graph_path, None)
+
+
+def read_commit_parents(wit_directory, commit_id):
+    commit_dir = get_images_dir(wit_directory) / commit_id
+    if not commit_exists(commit_dir):
+        raise CommitIdError("commit_id not found", commit_id)
+    if commit_id in load_shallow(wit_directory):
+        return []
+    parent = get_parent(commit_dir)
+    if parent is None:
+        return []
+    elif type(parent) is list:
+        return parent
+    return [parent]
+
+
+def get_commit_node(wit_directory, commit_id):
+    nodes = load_commit_graph(wit_directory)
+    if commit_id in nodes:
+        return nodes[commit_id]
+
+    new_nodes = {}
+    read_parents = {}
+    pending = [commit_id]
+    while pending:
+        current = pending[-1]
+        if current in nodes or current in new_nodes:
+            pending.pop()
+            continue
+        if current not in read_parents:
+            read_parents[current] = read_commit_parents(wit_directory, current)
+        parents = read_parents[current]
+        missing = [parent for parent in parents if parent not in nodes and parent not in new_nodes]
+        if missing:
+            pending.extend(missing)
+            continue
+        generation = 1 + max(
+            ((nodes.get(parent) or new_nodes[parent]).generation for parent in parents), default=0
+        )
+        new_nodes[current] = CommitNode(tuple(parents), generation)
+        pending.pop()
+
+    append_commit_graph(wit_directory, new_nodes)
+    return new_nodes[commit_id]
+
+
+def get_merge_base(wit_directory, commit1, commit2):
+    flags = {commit1: 1}
+    flags[commit2] = flags.get(commit2, 0) | 2
+    queue = [(-get_commit_node(wit_directory, commit_id).generation, commit_id) for commit_id in flags]
+    heapq.heapify(queue)
+    done = set()
+    while queue:
+        _, commit_id = heapq.heappop(queue)
+        if commit_id in done:
+            continue
+        done.add(commit_id)
+        flag = flags[commit_id]
+        if flag == 3:
+            return commit_id
+        for parent in get_commit_node(wit_directory, commit_id).parents:
+            parent_flag = flags.get(parent, 0)
+            if parent_flag | flag != parent_flag:
+                flags[parent] = parent_flag | flag
+                heapq.heappush(queue, (-get_commit_node(wit_directory, parent).generation, parent))
+    return None
+
+
+def is_ancestor(wit_directory, ancestor, commit_id):
+    return get_merge_base(wit_directory, ancestor, commit_id) == ancestor
+
+
+def worktrees_gen(wit_directory):
+    common_folder = get_common_folder(wit_directory)
+    yield common_folder.parent
+    for worktree_file in sorted((common_folder / 'worktrees').glob('*/worktree.txt')):
+        worktree_path = Path(read_key_values(worktree_file)['path'])
+        if (worktree_path / '.wit').is_file():
+            yield worktree_path
+
+
+def checked_out_branches(wit_directory, exclude=None):
+    branches = set()
+    for worktree_path in worktrees_gen(wit_directory):
+        if exclude is not None and worktree_path.resolve() == exclude.resolve():
+            continue
+        activated_branch = load_activated(worktree_path)
+        ref = load_references(worktree_path)
+        if activated_branch is not None and ref.get('HEAD') is not None:
+            if ref.get(activated_branch) == ref.get('HEAD'):
+                branches.add(activated_branch)
+    return branches
+
+
+def get_ref_heads(wit_directory):
+    heads = set()
+    for worktree_path in worktrees_gen(wit_directory):
+        heads.update(
+            commit_id for name, commit_id in load_references(worktree_path).items()
+            if name != 'added' and isinstance(commit_id, str)
+        )
+        merge_head = get_wit_folder(worktree_path) / 'merge_head.txt'
+        if merge_head.is_file():
+            heads.add(merge_head.read_text())
+    return heads
+
+
+def reachable_objects(wit_directory, commit_names):
+    reachable = set()
+    pending = []
+    for commit_name in commit_names:
+        reachable.add(commit_name)
+        pending.append(get_commit_tree(wit_directory, commit_name))
+    while pending:
+        tree_id = pending.pop()
+        if tree_id in reachable:
+            continue
+        reachable.add(tree_id)
+        for kind, object_id, _ in read_tree(wit_directory, tree_id):
+            if kind == 'tree':
+                pending.append(object_id)
+            elif object_id not in reachable:
+                reachable.add(object_id)
+                reachable.update(get_chunk_ids(wit_directory, object_id))
+    return reachable
+
+
+def prune_objects(wit_directory, reachable):
+    loose_ids = set(loose_objects_gen(wit_directory))
+    packed_ids = set(packed_objects_gen(wit_directory))
+    removed = (loose_ids | packed_ids) - reachable
+    if packed_ids - reachable:
+        old_packs = [pack[0] for pack in load_packs(wit_directory)]
+        kept_ids = sorted(packed_ids & reachable)
+        pack_path = None
+        if kept_ids:
+            pack_path = make_pack(wit_directory, kept_ids, find_delta_bases(wit_directory, set(kept_ids)))
+        for index_path in old_packs:
+            if pack_path is None or index_path != pack_path.with_suffix('.idx'):
+                index_path.unlink(missing_ok=True)
+                index_path.with_suffix('.pack').unlink(missing_ok=True)
+        PACKS.pop(get_pack_dir(wit_directory), None)
+    for object_id in loose_ids - reachable:
+        object_path = get_object_path(wit_directory, object_id)
+        object_path.unlink(missing_ok=True)
+        if not any(object_path.parent.iterdir()):
+            object_path.parent.rmdir()
+    return len(removed)
+
+
+def shallow(depth):
+    working_directory = Path(os.getcwd())
+    wit_directory = get_wit_dir(working_directory, start_from_parent=False)
+    if wit_directory is None:
+        raise NoWitError("No wit folder found", working_directory)
+    if depth < 1:
+        print("depth must be at least 1")
+        return
+
+    kept = set()
+    boundary = set()
+    queue = collections.deque((commit_id, 1) for commit_id in sorted(get_ref_heads(wit_directory)))
+    while queue:
+        commit_id, level = queue.popleft()
+        if commit_id in kept:
+            continue
+        kept.add(commit_id)
+        parents = get_commit_node(wit_directory, commit_id).parents
+        if level == depth:
+            if parents:
+                boundary.add(commit_id)
+            continue
+        queue.extend((parent, level + 1) for parent in parents)
+
+    dropped = set()
+    pending = [parent for commit_id in boundary for parent in get_commit_node(wit_directory, commit_id).parents]
+    while pending:
+        commit_id = pending.pop()
+        if commit_id in kept or commit_id in dropped:
+            continue
+        dropped.add(commit_id)
+        pending.extend(get_commit_node(wit_directory, commit_id).parents)
+
+    save_shallow(wit_directory, boundary | (load_shallow(wit_directory) & kept))
+    images = get_images_dir(wit_directory)
+    for commit_id in dropped:
+        (images / f"{commit_id}.txt").unlink(missing_ok=True)
+        if (images / commit_id).is_dir():
+            shutil.rmtree(images / commit_id)
+
+    reachable = reachable_objects(wit_directory, kept)
+    for worktree_path in worktrees_gen(wit_directory):
+        for entry in load_index(worktree_path).values():
+            reachable.add(entry.object_id)
+            reachable.update(get_chunk_ids(wit_directory, entry.object_id))
+    removed = prune_objects(wit_directory, reachable)
+    print(f"kept {len(kept)} commits, dropped {len(dropped)} commits and {removed} objects")
+
+
+def get_remote_dir(wit_directory, name):
+    path = get_config(wit_directory).get(f"remote.{name}")
+    if path is None:
+        raise BranchError("remote not found", name)
+    remote_directory = Path(path)
+    if not (remote_directory / '.wit').exists():
+        raise NoWitError("No wit folder found", remote_directory)
+    return remote_directory
+
+
+def get_remote_names(wit_directory):
+    return {key.split(".", 1)[1] for key in get_config(wit_directory) if key.startswith('remote.')}
+
+
+def get_tracked_branch(wit_directory, name):
+    remote_name, _, branch_name = name.partition("/")
+    if branch_name and remote_name in get_remote_names(wit_directory):
+        return branch_name
+    return None
+
+
+def get_remote_branches(wit_directory):
+    remote_names = get_remote_names(wit_directory)
+    return {
+        name: commit_id for name, commit_id in load_references(wit_directory).items()
+        if name not in ('HEAD', 'added') and isinstance(commit_id, str)
+        and name.split("/", 1)[0] not in remote_names
+    }
+
+
+def peek_commit_parents(wit_directory, commit_id):
+    node = load_commit_graph(wit_directory).get(commit_id)
+    if node is not None:
+        return node.parents
+    return read_commit_parents(wit_directory, commit_id)
+
+
+def missing_commits(source_directory, target_directory, tips):
+    target_images = get_images_dir(target_directory)
+    missing = []
+    seen = set()
+    pending = list(tips)
+    while pending:
+        commit_id = pending.pop()
+        if commit_id in seen or commit_exists(target_images / commit_id):
+            continue
+        seen.add(commit_id)
+        missing.append(commit_id)
+        pending.extend(peek_commit_parents(source_directory, commit_id))
+    return missing
+
+
+def missing_objects(source_directory, target_directory, commit_names):
+    object_ids = set()
+    pending = []
+    for commit_name in commit_names:
+        if has_object(source_directory, commit_name):
+            object_ids.add(commit_name)
+        pending.append(get_commit_tree(source_directory, commit_name))
+    while pending:
+        tree_id = pending.pop()
+        if tree_id in object_ids or has_object(target_directory, tree_id):
+            continue
+        object_ids.add(tree_id)
+        for kind, object_id, _ in read_tree(source_directory, tree_id):
+            if kind == 'tree':
+                pending.append(object_id)
+            elif object_id not in object_ids and not has_object(target_directory, object_id):
+                object_ids.add(object_id)
+                object_ids.update(
+                    chunk_id for chunk_id in get_chunk_ids(source_directory, object_id)
+                    if not has_object(target_directory, chunk_id)
+                )
+    return object_ids
+
+
+@traced('objects.transfer')
+def transfer_commits(source_directory, target_directory, tips):
+    commit_names = missing_commits(source_directory, target_directory, tips)
+    object_ids = missing_objects(source_directory, target_directory, commit_names)
+    if object_ids:
+        delta_bases = find_delta_bases(source_directory, object_ids, commit_names)
+        make_pack(source_directory, sorted(object_ids), delta_bases, get_pack_dir(target_directory))
+        PACKS.pop(get_pack_dir(target_directory), None)
+
+    source_images = get_images_dir(source_directory)
+    target_images = get_images_dir(target_directory)
+    for commit_name in commit_names:
+        commit_text = (source_images / f"{commit_name}.txt").read_text()
+        if 'tree' not in get_commit_info(source_images / commit_name):
+            commit_text = f"tree={get_commit_tree(source_directory, commit_name)}\n" + commit_text
+        save_object_file(
+            target_images / f"{commit_name}.txt", lambda temp_path: temp_path.write_text(commit_text), OBJECT_MODE
+        )
+    shallow_commits = load_shallow(source_directory) & set(commit_names)
+    if shallow_commits:
+        save_shallow(target_directory, load_shallow(target_directory) | shallow_commits)
+    return len(commit_names), len(object_ids)
+
+
+def remote(action=None, name=None, path=None):
+    working_directory = Path(os.getcwd())
+    wit_directory = get_wit_dir(working_directory, start_from_parent=False)
+    if wit_directory is None:
+        raise NoWitError("No wit folder found", working_directory)
+
+    remotes = {
+        key.split(".", 1)[1]: value for key, value in get_config(wit_directory).items() if key.startswith('remote.')
+    }
+    if action is None:
+        for remote_name in sorted(remotes):
+            print(f"{remote_name} {remotes[remote_name]}")
+        return
+    if not name or "/" in name or "=" in name:
+        raise BranchError("unauthorized name for remote", name)
+    if name in remotes:
+        print("remote name already exists")
+        return
+    remote_directory = (working_directory / path).resolve()
+    if not (remote_directory / '.wit').exists():
+        raise NoWitError("No wit folder found", remote_directory)
+    set_config(wit_directory, f"remote.{name}", os.fspath(remote_directory))
+
+
+def fetch(remote_name):
+    working_directory = Path(os.getcwd())
+    wit_directory = get_wit_dir(working_directory, start_from_parent=False)
+    if wit_directory is None:
+        raise NoWitError("No wit folder found", working_directory)
+    remote_directory = get_remote_dir(wit_directory, remote_name)
+
+    remote_branches = get_remote_branches(remote_directory)
+    commits, objects = transfer_commits(remote_directory, wit_directory, set(remote_branches.values()))
+    local_refs = load_references(wit_directory)
+    local_names = {*local_refs, load_activated(wit_directory)}
+    unborn = {
+        branch_name: commit_id for branch_name, commit_id in remote_branches.items()
+        if branch_name in local_names and local_refs.get(branch_name) is None
+    }
+    changes = {f"{remote_name}/{branch_name}": commit_id for branch_name, commit_id in remote_branches.items()}
+    changes.update(unborn)
+    update_references(wit_directory, changes, expected=dict.fromkeys(unborn))
+    print(f"fetched {commits} commits and {objects} objects from {remote_name}")
+    for branch_name in sorted(unborn):
+        print(f"branch {branch_name} set to {remote_name}/{branch_name}")
+
+
+def push(remote_name, branch_name=None):
+    working_directory = Path(os.getcwd())
+    wit_directory = get_wit_dir(working_directory, start_from_parent=False)
+    if wit_directory is None:
+        raise NoWitError("No wit folder found", working_directory)
+    remote_directory = get_remote_dir(wit_directory, remote_name)
+
+    if branch_name is None:
+        branch_name = load_activated(wit_directory)
+    commit_id = get_branch(wit_directory, branch_name)
+    if not isinstance(commit_id, str):
+        raise BranchError("branch not found", branch_name)
+
+    remote_refs = load_references(remote_directory)
+    remote_commit = remote_refs.get(branch_name)
+    if remote_commit == commit_id:
+        print("everything up to date")
+        return
+    if remote_commit is not None:
+        if not commit_exists(get_images_dir(wit_directory) / remote_commit):
+            raise BranchError("push rejected, fetch the remote changes first", branch_name)
+        if not is_ancestor(wit_directory, remote_commit, commit_id):
+            raise BranchError("push rejected, not a fast-forward", branch_name)
+    if branch_name in checked_out_branches(remote_directory):
+        raise BranchError("push rejected, branch is checked out in the remote", branch_name)
+
+    commits, objects = transfer_commits(wit_directory, remote_directory, [commit_id])
+    update_references(remote_directory, {branch_name: commit_id}, expected={branch_name: remote_commit})
+    update_references(wit_directory, {f"{remote_name}/{branch_name}": commit_id})
+    print(f"pushed {commits} commits and {objects} objects to {remote_name}")
+
+
+def get_commit_date(wit_directory, commit_id):
+    info = get_commit_info(get_images_dir(wit_directory) / commit_id)
+    return datetime.datetime.strptime(info['date'], '%a %b %d %H:%M:%S %Y')
+
+
+def history_gen(wit_directory, heads, since=None):
+    heads = set(heads)
+    queue = [(-get_commit_node(wit_directory, commit_id).generation, commit_id) for commit_id in heads]
+    heapq.heapify(queue)
+    seen = set(heads)
+    while queue:
+        _, commit_id = heapq.heappop(queue)
+        if since is not None and get_commit_date(wit_directory, commit_id) < since:
+            continue
+        node = get_commit_node(wit_directory, commit_id)
+        yield commit_id, node
+        for parent in node.parents:
+            if parent not in seen:
+                seen.add(parent)
+                heapq.heappush(queue, (-get_commit_node(wit_directory, parent).generation, parent))
 
 
 def make_graph(parents_dict):
+    import matplotlib.pyplot as plt
+    import networkx as nx
+
     nodes = set()
     edges = []
     for head, parent in parents_dict.items():
+        nodes.add(head)
         if type(parent) is list:
             for p in parent:
-                nodes.add(p[:6])
-                edges.append((head[:6], p[:6]))
+                nodes.add(p)
+                edges.append((head, p))
         else:
-            nodes.add(parent[:6])
-            edges.append((head[:6], parent[:6]))
+            nodes.add(parent)
+            edges.append((head, parent))
 
     graph = nx.DiGraph()
     graph.add_nodes_from(nodes)
@@ -477,12 +2726,164 @@ def make_graph(parents_dict):
 
     pos = nx.spring_layout(graph)
     nx.draw_networkx_nodes(graph, pos, node_size=10000)
-    nx.draw_networkx_labels(graph, pos)
+    nx.draw_networkx_labels(graph, pos, labels={node: node[:10] for node in graph.nodes})
     nx.draw_networkx_edges(graph, pos, arrowsize=100, edge_color="aqua", width=10)
     plt.show()
 
 
-def graph():
+def get_commit_label(wit_directory, commit_id, ref_names):
+    message = get_commit_info(get_images_dir(wit_directory) / commit_id).get('message', "")
+    names = ref_names.get(commit_id)
+    if names:
+        return f"{commit_id[:10]} ({', '.join(names)}) {message}"
+    return f"{commit_id[:10]} {message}"
+
+
+def get_ref_names(wit_directory):
+    ref_names = {}
+    for name, commit_id in load_references(wit_directory).items():
+        if name != 'added' and isinstance(commit_id, str):
+            ref_names.setdefault(commit_id, []).append(name)
+    return ref_names
+
+
+def place_in_lane(lanes, commit_id):
+    if None in lanes:
+        lane = lanes.index(None)
+        lanes[lane] = commit_id
+        return lane
+    lanes.append(commit_id)
+    return len(lanes) - 1
+
+
+def make_lane_row(lanes, marked_lane=None):
+    row = "".join(
+        "* " if lane == marked_lane else ("| " if commit_id is not None else "  ")
+        for lane, commit_id in enumerate(lanes)
+    )
+    return row.rstrip()
+
+
+def make_connector_row(lanes, edges, hidden_lanes):
+    chars = list(make_lane_row(lanes).ljust(len(lanes) * 2))
+    for lane in hidden_lanes:
+        chars[lane * 2] = ' '
+    for source, target in edges:
+        if target > source:
+            chars[source * 2 + 1] = '\\'
+            for position in range(source * 2 + 2, target * 2):
+                if chars[position] == ' ':
+                    chars[position] = '-'
+            if target in hidden_lanes:
+                chars[target * 2 - 1] = '\\'
+        else:
+            chars[source * 2 - 1] = '/'
+            for position in range(target * 2 + 1, source * 2 - 1):
+                if chars[position] == ' ':
+                    chars[position] = '-'
+    return "".join(chars).rstrip()
+
+
+def lane_layout_gen(commits):
+    lanes = []
+    for commit_id, node in commits:
+        waiting = [lane for lane, lane_commit in enumerate(lanes) if lane_commit == commit_id]
+        if waiting:
+            lane = waiting[0]
+            for other in waiting[1:]:
+                lanes[other] = None
+            if len(waiting) > 1:
+                lanes_before = lanes[:]
+                for other in waiting[1:]:
+                    lanes_before[other] = commit_id
+                edges = [(other, lane) for other in waiting[1:]]
+                yield 'connector', make_connector_row(lanes_before, edges, waiting[1:])
+        else:
+            lane = place_in_lane(lanes, commit_id)
+        yield 'commit', (commit_id, node, lane, make_lane_row(lanes, lane))
+
+        lanes[lane] = node.parents[0] if node.parents else None
+        edges = []
+        new_lanes = []
+        for parent in node.parents[1:]:
+            if parent in lanes:
+                edges.append((lane, lanes.index(parent)))
+            else:
+                new_lanes.append(place_in_lane(lanes, parent))
+                edges.append((lane, new_lanes[-1]))
+        if edges:
+            yield 'connector', make_connector_row(lanes, edges, new_lanes)
+        while lanes and lanes[-1] is None:
+            lanes.pop()
+
+
+def ascii_graph_gen(wit_directory, commits):
+    ref_names = get_ref_names(wit_directory)
+    for kind, item in lane_layout_gen(commits):
+        if kind == 'connector':
+            yield item
+        else:
+            commit_id, _, _, row = item
+            yield f"{row} {get_commit_label(wit_directory, commit_id, ref_names)}".rstrip()
+
+
+def dot_quote(text):
+    return '"' + text.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def dot_graph_gen(wit_directory, commits):
+    ref_names = get_ref_names(wit_directory)
+    yield "digraph wit {"
+    yield "  rankdir=TB;"
+    yield "  node [shape=box, fontname=monospace];"
+    for commit_id, node in commits:
+        label = get_commit_label(wit_directory, commit_id, ref_names)
+        yield f"  {dot_quote(commit_id)} [label={dot_quote(label)}];"
+        for parent in node.parents:
+            yield f"  {dot_quote(commit_id)} -> {dot_quote(parent)};"
+    yield "}"
+
+
+def svg_escape(text):
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('"', '&quot;')
+
+
+def svg_graph_gen(wit_directory, commits):
+    ref_names = get_ref_names(wit_directory)
+    lane_width = 20
+    row_height = 24
+    positions = {}
+    rows = []
+    for kind, item in lane_layout_gen(commits):
+        if kind == 'commit':
+            commit_id, node, lane, _ = item
+            positions[commit_id] = (lane, len(rows))
+            rows.append((commit_id, node))
+
+    width = (max((lane for lane, _ in positions.values()), default=0) + 1) * lane_width
+    height = (len(rows) + 1) * row_height
+    yield (
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{width + 600}" height="{height}" '
+        f'font-family="monospace" font-size="12">'
+    )
+    for commit_id, node in rows:
+        lane, row = positions[commit_id]
+        x, y = lane * lane_width + lane_width // 2, row * row_height + row_height
+        for parent in node.parents:
+            parent_lane, parent_row = positions.get(parent, (lane, len(rows)))
+            parent_x = parent_lane * lane_width + lane_width // 2
+            parent_y = parent_row * row_height + row_height
+            yield f'<line x1="{x}" y1="{y}" x2="{parent_x}" y2="{parent_y}" stroke="#4a90d9" stroke-width="2"/>'
+    for commit_id, node in rows:
+        lane, row = positions[commit_id]
+        x, y = lane * lane_width + lane_width // 2, row * row_height + row_height
+        label = svg_escape(get_commit_label(wit_directory, commit_id, ref_names))
+        yield f'<circle cx="{x}" cy="{y}" r="5" fill="#1f5fa8"><title>{commit_id}</title></circle>'
+        yield f'<text x="{width + 10}" y="{y + 4}">{label}</text>'
+    yield '</svg>'
+
+
+def graph(graph_format='ascii', limit=None, since=None):
     working_directory = Path(os.getcwd())
     wit_directory = get_wit_dir(working_directory, start_from_parent=False)
     if wit_directory is None:
@@ -497,28 +2898,26 @@ def graph():
     elif master is None:
         print("no master found")
     else:
-        parents = get_parents(wit_directory, head)
-        make_graph(parents)
+        if since is not None:
+            since = datetime.datetime.fromisoformat(since)
+        commits = itertools.islice(history_gen(wit_directory, [head], since), limit)
+        if graph_format == 'plot':
+            parents = {}
+            for commit_id, node in commits:
+                if node.parents:
+                    parents[commit_id] = list(node.parents) if len(node.parents) > 1 else node.parents[0]
+            make_graph(parents)
+            return
+        graph_gens = {'ascii': ascii_graph_gen, 'dot': dot_graph_gen, 'svg': svg_graph_gen}
+        for line in graph_gens[graph_format](wit_directory, commits):
+            print(line)
 
 
 def get_branch(wit_directory, name):
-    references = wit_directory / '.wit' / 'references.txt'
-    if references.is_file():
-        with open(references, 'r') as ref_file:
-            ref_lines = ref_file.readlines()
-        for line in ref_lines:
-            branch_name, commit_id = line.split("=")
-            if name == branch_name.strip():
-                name = name + '='
-                return commit_id.strip()
-        return None
-    else:
-        make_references(wit_directory, None, None, False)
-        return None
+    return load_references(wit_directory).get(name)
 
 
 def add_branch(wit_directory, name):
-    references = wit_directory / '.wit' / 'references.txt'
     unauthorized_names = ['HEAD', 'master', 'added', ""]
     if name in unauthorized_names:
         raise BranchError("unauthorized names for branch", name)
@@ -527,8 +2926,7 @@ def add_branch(wit_directory, name):
     if commit_id is None:
         print("commit not found")
     else:
-        with open(references, 'a') as ref_file:
-            ref_file.write(f"{name}={commit_id}\n")
+        update_references(wit_directory, {name: commit_id})
 
 
 def branch(name):
@@ -536,35 +2934,218 @@ def branch(name):
     wit_directory = get_wit_dir(working_directory, start_from_parent=False)
     if wit_directory is None:
         raise NoWitError("No wit folder found", working_directory)
-    commit_name = get_branch(wit_directory, name)
-    if commit_name is None:
+    if name not in load_references(wit_directory):
         add_branch(wit_directory, name)
     else:
         print("branch name already exists")
 
 
-def get_common_ground(parents_1, head1, parents_2, head2):
-    parents_1_list = []
-    parents_2_list = []
-    p1 = head1
-    p2 = head2
-    while p1 is not None:
-        
-        if type(p1) is list:
-            p1 = p1[0]
-        parents_1_list.append(p1)
-        p1 = parents_1.get(p1)
-    while p2 is not None:
-        if type(p2) is list:
-            p2 = p2[0]
-        parents_2_list.append(p2)
-        p2 = parents_2.get(p2)
-
-    for p1 in parents_1_list:
-        for p2 in parents_2_list:
-            if p1 == p2:
-                return p1
-    return None
+def worktree(action=None, path=None, branch_name=None):
+    working_directory = Path(os.getcwd())
+    wit_directory = get_wit_dir(working_directory, start_from_parent=False)
+    if wit_directory is None:
+        raise NoWitError("No wit folder found", working_directory)
+
+    if action is None:
+        for worktree_path in worktrees_gen(wit_directory):
+            head = load_references(worktree_path).get('HEAD')
+            activated_branch = load_activated(worktree_path)
+            print(f"{worktree_path} {head} [{activated_branch}]")
+        return
+
+    commit_id = get_branch(wit_directory, branch_name)
+    if branch_name in WORKTREE_REFERENCES or not isinstance(commit_id, str):
+        raise BranchError("branch not found", branch_name)
+    if branch_name in checked_out_branches(wit_directory):
+        raise BranchError("branch is already checked out in a worktree", branch_name)
+    worktree_path = (working_directory / path).resolve()
+    if worktree_path.exists() and any(worktree_path.iterdir()):
+        raise CheckoutError("worktree path is not empty", worktree_path)
+
+    common_folder = get_common_folder(wit_directory).resolve()
+    (common_folder / 'worktrees').mkdir(exist_ok=True)
+    wit_folder = Path(tempfile.mkdtemp(prefix=f"{worktree_path.name}-", dir=common_folder / 'worktrees'))
+    (wit_folder / 'worktree.txt').write_text(f"common={common_folder}\npath={worktree_path}\n")
+    (wit_folder / 'activated.txt').write_text(branch_name)
+    worktree_path.mkdir(parents=True, exist_ok=True)
+    (worktree_path / '.wit').write_text(f"folder={wit_folder}\n")
+
+    commit_files = tree_files(worktree_path, get_commit_tree(worktree_path, commit_id))
+    index = make_checkout(commit_files, worktree_path, {}, TreeDiff([], [], [], []))
+    save_index(worktree_path, index)
+    update_references(worktree_path, {'HEAD': commit_id, 'added': False})
+    print(f"created worktree {worktree_path} on {branch_name}")
+
+
+def intern_lines(lines, line_ids):
+    return [line_ids.setdefault(line, len(line_ids)) for line in lines]
+
+
+def myers_middle_snake(a, b, a_lo, a_hi, b_lo, b_hi):
+    n = a_hi - a_lo
+    m = b_hi - b_lo
+    delta = n - m
+    odd = delta % 2 == 1
+    limit = min((n + m + 1) // 2, MYERS_MAX_COST)
+    offset = limit + 1
+    forward = [0] * (2 * offset + 1)
+    backward = [0] * (2 * offset + 1)
+    for d in range(limit + 1):
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and forward[offset + k - 1] < forward[offset + k + 1]):
+                x = forward[offset + k + 1]
+            else:
+                x = forward[offset + k - 1] + 1
+            y = x - k
+            start_x, start_y = x, y
+            while x < n and y < m and a[a_lo + x] == b[b_lo + y]:
+                x += 1
+                y += 1
+            forward[offset + k] = x
+            if odd and -d < delta - k < d and x + backward[offset + delta - k] >= n:
+                return start_x, start_y, x, y
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and backward[offset + k - 1] < backward[offset + k + 1]):
+                x = backward[offset + k + 1]
+            else:
+                x = backward[offset + k - 1] + 1
+            y = x - k
+            start_x, start_y = x, y
+            while x < n and y < m and a[a_hi - 1 - x] == b[b_hi - 1 - y]:
+                x += 1
+                y += 1
+            backward[offset + k] = x
+            if not odd and -d <= delta - k <= d and x + forward[offset + delta - k] >= n:
+                return n - x, m - y, n - start_x, m - start_y
+
+    x, y = n // 2, m // 2
+    for k in range(-limit, limit + 1, 2):
+        reach = forward[offset + k]
+        if reach <= n and 0 <= reach - k <= m and 0 < 2 * reach - k < n + m and 2 * reach - k > x + y:
+            x, y = reach, reach - k
+    return x, y, x, y
+
+
+def myers_matches(a, b):
+    matches = []
+    pending = [(0, len(a), 0, len(b))]
+    while pending:
+        a_lo, a_hi, b_lo, b_hi = pending.pop()
+        while a_lo < a_hi and b_lo < b_hi and a[a_lo] == b[b_lo]:
+            matches.append((a_lo, b_lo))
+            a_lo += 1
+            b_lo += 1
+        while a_lo < a_hi and b_lo < b_hi and a[a_hi - 1] == b[b_hi - 1]:
+            a_hi -= 1
+            b_hi -= 1
+            matches.append((a_hi, b_hi))
+        if a_lo == a_hi or b_lo == b_hi:
+            continue
+        x, y, u, v = myers_middle_snake(a, b, a_lo, a_hi, b_lo, b_hi)
+        matches.extend((a_lo + x + i, b_lo + y + i) for i in range(u - x))
+        pending.append((a_lo, a_lo + x, b_lo, b_lo + y))
+        pending.append((a_lo + u, a_hi, b_lo + v, b_hi))
+    matches.sort()
+    return matches
+
+
+def match_lines(a, b):
+    if not a or not b:
+        return []
+    common = set(a).intersection(b)
+    a_index = [i for i, line in enumerate(a) if line in common]
+    b_index = [j for j, line in enumerate(b) if line in common]
+    middle = myers_matches([a[i] for i in a_index], [b[j] for j in b_index])
+    return [(a_index[i], b_index[j]) for i, j in middle]
+
+
+def terminate_lines(lines):
+    if lines and not lines[-1].endswith(b"\n"):
+        return lines[:-1] + [lines[-1] + b"\n"]
+    return lines
+
+
+def merge_lines(base, ours, theirs, labels):
+    line_ids = {}
+    base_ids = intern_lines(base, line_ids)
+    ours_ids = intern_lines(ours, line_ids)
+    theirs_ids = intern_lines(theirs, line_ids)
+    ours_matches = dict(match_lines(base_ids, ours_ids))
+    theirs_matches = dict(match_lines(base_ids, theirs_ids))
+    syncs = [
+        (index, ours_matches[index], theirs_matches[index])
+        for index in range(len(base)) if index in ours_matches and index in theirs_matches
+    ]
+    syncs.append((len(base), len(ours), len(theirs)))
+
+    merged = []
+    conflicts = 0
+    base_start = ours_start = theirs_start = 0
+    for base_end, ours_end, theirs_end in syncs:
+        base_chunk = base_ids[base_start:base_end]
+        ours_chunk = ours_ids[ours_start:ours_end]
+        theirs_chunk = theirs_ids[theirs_start:theirs_end]
+        if ours_chunk == theirs_chunk or theirs_chunk == base_chunk:
+            merged.extend(ours[ours_start:ours_end])
+        elif ours_chunk == base_chunk:
+            merged.extend(theirs[theirs_start:theirs_end])
+        else:
+            conflicts += 1
+            merged.append(b"<<<<<<< " + labels[0] + b"\n")
+            merged.extend(terminate_lines(ours[ours_start:ours_end]))
+            merged.append(b"=======\n")
+            merged.extend(terminate_lines(theirs[theirs_start:theirs_end]))
+            merged.append(b">>>>>>> " + labels[1] + b"\n")
+        if base_end < len(base):
+            merged.append(ours[ours_end])
+        base_start, ours_start, theirs_start = base_end + 1, ours_end + 1, theirs_end + 1
+    return merged, conflicts
+
+
+@traced('diff.merge_file')
+def get_merge_conflicts_path(wit_directory):
+    return get_wit_folder(wit_directory) / 'merge_conflicts.txt'
+
+
+def load_merge_conflicts(wit_directory):
+    conflicts_path = get_merge_conflicts_path(wit_directory)
+    if not conflicts_path.is_file():
+        return {}
+    conflicts = {}
+    for line in conflicts_path.read_text().splitlines():
+        name, object_id = line.rsplit("=", 1)
+        conflicts[name] = None if object_id == "None" else object_id
+    return conflicts
+
+
+def save_merge_conflicts(wit_directory, conflicts):
+    conflicts_path = get_merge_conflicts_path(wit_directory)
+    if not conflicts:
+        conflicts_path.unlink(missing_ok=True)
+        return
+    conflicts_path.write_text("".join(f"{name}={object_id}\n" for name, object_id in sorted(conflicts.items())))
+
+
+def get_unresolved_conflicts(wit_directory, index):
+    return sorted(
+        name for name, object_id in load_merge_conflicts(wit_directory).items()
+        if (index[name].object_id if name in index else None) == object_id
+    )
+
+
+def merge_file(wit_directory, base_id, head_id, branch_id, labels):
+    if head_id is None or branch_id is None:
+        return head_id or branch_id, 'delete'
+    base = read_blob(wit_directory, base_id) if base_id else b""
+    head = read_blob(wit_directory, head_id)
+    branch = read_blob(wit_directory, branch_id)
+    if b"\0" in base or b"\0" in head or b"\0" in branch:
+        return head_id, 'binary'
+    lines, conflicts = merge_lines(
+        base.splitlines(keepends=True), head.splitlines(keepends=True), branch.splitlines(keepends=True), labels
+    )
+    object_id = write_blob_data(wit_directory, b"".join(lines))
+    return object_id, 'content' if conflicts else None
 
 
 def merge(branch_name):
@@ -573,8 +3154,8 @@ def merge(branch_name):
     if wit_directory is None:
         raise NoWitError("No wit folder found", working_directory)
     
-    staging_area = wit_directory / '.wit' / 'staging_area'
-    if not check_status(wit_directory, staging_area):
+    tree_diff = get_tree_diff(wit_directory)
+    if not check_status(tree_diff):
         raise DataNotSaved()
 
     commit_name = get_branch(wit_directory, branch_name)
@@ -586,62 +3167,580 @@ def merge(branch_name):
     if head is None:
         raise CommitIdError("HEAD commit not found")
 
-    head_parents = get_parents(wit_directory, head)
-    commit_parents = get_parents(wit_directory, commit_name)
-    common_ground = get_common_ground(head_parents, head, commit_parents, commit_name)
+    common_ground = get_merge_base(wit_directory, head, commit_name)
     if common_ground is None:
         raise MergeError("common ground not found", branch_name)
-    
-    common_ground_dir = wit_directory / '.wit' / 'images' / common_ground
-    commit_id = wit_directory / '.wit' / 'images' / commit_name
-    
-    wit_path = os.fspath(wit_directory)
-    commit_path = os.fspath(commit_id)
-    staging_path = os.fspath(staging_area)
+    if common_ground == commit_name:
+        print("already up to date")
+        return
+
+    base_files = get_head_files(wit_directory, common_ground)
+    head_files = get_head_files(wit_directory, head)
+    branch_files = get_head_files(wit_directory, commit_name)
+
+    merged_files = dict(head_files)
+    to_merge = []
+    for name in branch_files.keys() | base_files.keys():
+        base_id = base_files.get(name)
+        head_id = head_files.get(name)
+        branch_id = branch_files.get(name)
+        if branch_id == base_id or branch_id == head_id:
+            continue
+        if head_id == base_id:
+            merged_files[name] = branch_id
+        else:
+            to_merge.append((name, base_id, head_id, branch_id))
+
+    labels = (b"HEAD", branch_name.encode())
+    results = map_jobs(wit_directory, lambda item: merge_file(wit_directory, *item[1:], labels), to_merge)
+    conflicts = []
+    for (name, _, head_id, _), (object_id, conflict) in zip(to_merge, results):
+        if conflict is None:
+            merged_files[name] = object_id
+        elif object_id != head_id:
+            conflicts.append((name, conflict, object_id))
+        else:
+            conflicts.append((name, conflict, None))
+    merged_files = {name: object_id for name, object_id in merged_files.items() if object_id is not None}
+
+    sparse = load_sparse(wit_directory)
+    if conflicts and sparse:
+        outside = sorted(
+            name for name in merged_files.keys() | head_files.keys()
+            if not in_sparse(name, sparse) and merged_files.get(name) != head_files.get(name)
+        )
+        outside.extend(name for name, _, _ in conflicts if not in_sparse(name, sparse))
+        if outside:
+            raise MergeError("conflicting merge changes files outside the sparse checkout", outside[0])
+
+    checkout_files = {name: object_id for name, object_id in merged_files.items() if in_sparse(name, sparse)}
+    index = make_checkout(checkout_files, wit_directory, load_index(wit_directory), tree_diff)
+    save_index(wit_directory, index)
+
+    if not conflicts:
+        save_commit(wit_directory, write_files_tree(wit_directory, merged_files), "--merged--", commit_name)
+        return
+
+    save_merge_conflicts(wit_directory, {
+        name: index[name].object_id if name in index else None for name, _, _ in conflicts
+    })
+    update_references(wit_directory, {'added': True})
+
+    for name, conflict, object_id in sorted(conflicts):
+        if object_id is not None:
+            checkout_file(wit_directory, name, object_id)
+        print(f"conflict ({conflict}): {name}")
+    (get_wit_folder(wit_directory) / 'merge_head.txt').write_text(commit_name)
+    print("automatic merge failed: fix the conflicts, add the files and commit the result")
+
+
+def changed_blocks(matches, a_length, b_length):
+    blocks = []
+    a_start = b_start = 0
+    for a_match, b_match in matches + [(a_length, b_length)]:
+        if a_match > a_start or b_match > b_start:
+            blocks.append((a_start, a_match, b_start, b_match))
+        a_start, b_start = a_match + 1, b_match + 1
+    return blocks
+
+
+def diff_blocks(a, b):
+    if not a or not b:
+        return [(0, len(a), 0, len(b))] if a or b else []
+    line_ids = {}
+    a_ids = intern_lines(a, line_ids)
+    b_ids = intern_lines(b, line_ids)
+    return changed_blocks(match_lines(a_ids, b_ids), len(a), len(b))
+
+
+def hunk_range(start, end):
+    if end - start == 1:
+        return f"{start + 1}"
+    if end == start:
+        return f"{start},0"
+    return f"{start + 1},{end - start}"
+
+
+def hunk_lines_gen(prefix, lines):
+    for line in lines:
+        text = line.decode(errors='replace')
+        if text.endswith("\n"):
+            yield prefix + text[:-1]
+        else:
+            yield prefix + text
+            yield "\\ No newline at end of file"
+
+
+def make_hunk(a, b, blocks, context):
+    a_start = max(0, blocks[0][0] - context)
+    b_start = blocks[0][2] - (blocks[0][0] - a_start)
+    a_end = min(len(a), blocks[-1][1] + context)
+    b_end = blocks[-1][3] + (a_end - blocks[-1][1])
+    lines = [f"@@ -{hunk_range(a_start, a_end)} +{hunk_range(b_start, b_end)} @@"]
+    position = a_start
+    for a_low, a_high, b_low, b_high in blocks:
+        lines.extend(hunk_lines_gen(" ", a[position:a_low]))
+        lines.extend(hunk_lines_gen("-", a[a_low:a_high]))
+        lines.extend(hunk_lines_gen("+", b[b_low:b_high]))
+        position = a_high
+    lines.extend(hunk_lines_gen(" ", a[position:a_end]))
+    return lines
+
+
+def unified_hunks_gen(a, b, context=3):
+    group = []
+    for block in diff_blocks(a, b):
+        if group and block[0] - group[-1][1] > 2 * context:
+            yield make_hunk(a, b, group, context)
+            group = []
+        group.append(block)
+    if group:
+        yield make_hunk(a, b, group, context)
+
+
+def is_binary(data):
+    return b"\0" in data
+
+
+def unified_diff_gen(changes, read_old, read_new):
+    for name, old_id, new_id in changes:
+        old = read_old(name, old_id) if old_id else b""
+        new = read_new(name, new_id) if new_id else b""
+        yield f"diff --wit a/{name} b/{name}"
+        if old_id is None:
+            yield "new file"
+        elif new_id is None:
+            yield "deleted file"
+        if is_binary(old) or is_binary(new):
+            yield f"Binary files a/{name} and b/{name} differ"
+            continue
+        yield f"--- {'a/' + name if old_id else '/dev/null'}"
+        yield f"+++ {'b/' + name if new_id else '/dev/null'}"
+        for hunk in unified_hunks_gen(old.splitlines(keepends=True), new.splitlines(keepends=True)):
+            yield from hunk
+
+
+def diff_stat_gen(changes, read_old, read_new, width=40):
+    stats = []
+    for name, old_id, new_id in changes:
+        old = read_old(name, old_id) if old_id else b""
+        new = read_new(name, new_id) if new_id else b""
+        if is_binary(old) or is_binary(new):
+            stats.append((name, None, None))
+            continue
+        blocks = diff_blocks(old.splitlines(keepends=True), new.splitlines(keepends=True))
+        removed = sum(a_high - a_low for a_low, a_high, _, _ in blocks)
+        added = sum(b_high - b_low for _, _, b_low, b_high in blocks)
+        stats.append((name, added, removed))
+    if not stats:
+        return
+    name_width = max(len(name) for name, _, _ in stats)
+    largest = max((added + removed for _, added, removed in stats if added is not None), default=0)
+    scale = min(1, width / largest) if largest else 1
+    for name, added, removed in stats:
+        if added is None:
+            yield f" {name:<{name_width}} | Bin"
+            continue
+        yield f" {name:<{name_width}} | {added + removed:>5} {'+' * round(added * scale)}{'-' * round(removed * scale)}"
+    insertions = sum(added for _, added, _ in stats if added is not None)
+    deletions = sum(removed for _, _, removed in stats if removed is not None)
+    yield f" {len(stats)} files changed, {insertions} insertions(+), {deletions} deletions(-)"
+
+
+def resolve_commit(wit_directory, name):
+    commit_name = load_references(wit_directory).get(name)
+    if not isinstance(commit_name, str):
+        commit_name = name
+    if not commit_exists(get_images_dir(wit_directory) / commit_name):
+        raise CommitIdError("commit_id or branch not found", name)
+    return commit_name
+
+
+def get_working_files(wit_directory):
+    index = load_index(wit_directory)
+    names = list(index)
+    checked = map_jobs(wit_directory, lambda name: check_index_entry(wit_directory, name, index[name]), names)
+    return {name: entry.object_id for name, entry in zip(names, checked) if entry is not None}
+
+
+def diff(first=None, second=None, stat=False):
+    working_directory = Path(os.getcwd())
+    wit_directory = get_wit_dir(working_directory, start_from_parent=False)
+    if wit_directory is None:
+        raise NoWitError("No wit folder found", working_directory)
 
-    master = ref.get('master')
-    make_references(wit_directory, head, master, True)
+    def read_old(name, object_id):
+        return read_blob(wit_directory, object_id)
+
+    def read_working(name, object_id):
+        return (wit_directory / name).read_bytes()
+
+    if second is not None:
+        old_tree = get_commit_tree(wit_directory, resolve_commit(wit_directory, first))
+        new_tree = get_commit_tree(wit_directory, resolve_commit(wit_directory, second))
+        changes = list(diff_trees_gen(wit_directory, old_tree, new_tree))
+        read_new = read_old
+    else:
+        if first is None:
+            old_files = {name: entry.object_id for name, entry in load_index(wit_directory).items()}
+        else:
+            old_files = get_head_files(
+                wit_directory, resolve_commit(wit_directory, first), load_sparse(wit_directory)
+            )
+        changes = list(diff_files_gen(old_files, get_working_files(wit_directory)))
+        read_new = read_working
 
-    changed_files = to_be_committed_gen(commit_id, common_ground_dir, wit_directory)
-    for changed_file in changed_files:
-        commit_file_path = os.fspath(changed_file).replace(wit_path, commit_path)
-        commit_file_path = Path(commit_file_path)
-        staging_file_dir = os.fspath(changed_file).replace(wit_path, staging_path)
-        staging_file_dir = Path(staging_file_dir)
-        if commit_file_path.is_file():
-            shutil.copy2(commit_file_path, staging_file_dir)
+    diff_gen = diff_stat_gen if stat else unified_diff_gen
+    for line in diff_gen(changes, read_old, read_new):
+        print(line)
 
-    message = "--merged--"
-    parent2 = commit_name
-    commit(message, parent2)
 
-    ref = get_from_references(wit_directory)
-    head = ref.get("HEAD")
-    checkout(head, check_stat=False)
-
-
-if len(sys.argv) == 2:
-    if sys.argv[1] == "init":
-        init()
-    elif sys.argv[1] == "status":
-        status()
-    elif sys.argv[1] == "graph":
-        graph()
-
-elif len(sys.argv) >= 3:
-    if sys.argv[1] == "add":
-        path = sys.argv[2]
-        add(path)
-    elif sys.argv[1] == "commit":
-        message = sys.argv[2:]
-        message = " ".join(message)
-        commit(message)
-    elif sys.argv[1] == "checkout":
-        name = sys.argv[2]
-        checkout(name)
-    elif sys.argv[1] == "branch":
-        name = sys.argv[2]
-        branch(name)
-    elif sys.argv[1] == "merge":
-        branch_name = sys.argv[2]
-        merge(branch_name)
\ No newline at end of file
+def log(limit=None, skip=0, stat=False):
+    working_directory = Path(os.getcwd())
+    wit_directory = get_wit_dir(working_directory, start_from_parent=False)
+    if wit_directory is None:
+        raise NoWitError("No wit folder found", working_directory)
+
+    head = get_from_references(wit_directory).get('HEAD')
+    if head is None:
+        print("no commit_id found")
+        return
+
+    def read_blob_data(name, object_id):
+        return read_blob(wit_directory, object_id)
+
+    ref_names = get_ref_names(wit_directory)
+    end = None if limit is None else skip + limit
+    for commit_id, node in itertools.islice(history_gen(wit_directory, [head]), skip, end):
+        info = get_commit_info(get_images_dir(wit_directory) / commit_id)
+        names = ref_names.get(commit_id)
+        print(f"commit {commit_id} ({', '.join(names)})" if names else f"commit {commit_id}")
+        if len(node.parents) > 1:
+            print(f"Merge: {' '.join(parent[:10] for parent in node.parents)}")
+        print(f"Date:   {info.get('date')}")
+        print()
+        print(f"    {info.get('message', '')}")
+        print()
+        if stat:
+            parent_tree = get_commit_tree(wit_directory, node.parents[0]) if node.parents else None
+            tree_id = get_commit_tree(wit_directory, commit_id)
+            changes = diff_trees_gen(wit_directory, parent_tree, tree_id)
+            for line in diff_stat_gen(changes, read_blob_data, read_blob_data):
+                print(line)
+            print()
+
+
+def archive_blob_gen(wit_directory, object_id, size):
+    written = 0
+    for piece in blob_chunks_gen(wit_directory, object_id):
+        written += len(piece)
+        yield piece
+    if written != size:
+        raise ObjectError("blob size does not match its contents", object_id)
+
+
+def tar_archive_gen(wit_directory, entries, mtime):
+    import tarfile
+
+    for name, object_id, size in entries:
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = mtime
+        info.mode = 0o644
+        yield info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape')
+        yield from archive_blob_gen(wit_directory, object_id, size)
+        if size % tarfile.BLOCKSIZE:
+            yield bytes(tarfile.BLOCKSIZE - size % tarfile.BLOCKSIZE)
+    yield bytes(2 * tarfile.BLOCKSIZE)
+
+
+def write_zip_archive(wit_directory, entries, date, out):
+    import zipfile
+
+    with zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        for name, object_id, size in entries:
+            info = zipfile.ZipInfo(name, date.timetuple()[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.external_attr = 0o644 << 16
+            with zip_file.open(info, 'w', force_zip64=size >= zipfile.ZIP64_LIMIT) as entry_file:
+                for piece in archive_blob_gen(wit_directory, object_id, size):
+                    entry_file.write(piece)
+
+
+@traced('copy.archive')
+def write_archive(wit_directory, entries, archive_format, date, out):
+    if archive_format == 'zip':
+        write_zip_archive(wit_directory, entries, date, out)
+        return
+    mtime = int(date.timestamp())
+    if archive_format == 'tar.gz':
+        import gzip
+
+        with gzip.GzipFile(fileobj=out, mode='wb', mtime=mtime) as gzip_file:
+            for piece in tar_archive_gen(wit_directory, entries, mtime):
+                gzip_file.write(piece)
+    else:
+        for piece in tar_archive_gen(wit_directory, entries, mtime):
+            out.write(piece)
+    out.flush()
+
+
+def archive(name, archive_format='tar', output=None, prefix="", paths=()):
+    working_directory = Path(os.getcwd())
+    wit_directory = get_wit_dir(working_directory, start_from_parent=False)
+    if wit_directory is None:
+        raise NoWitError("No wit folder found", working_directory)
+
+    commit_name = resolve_commit(wit_directory, name)
+    paths = tuple(path.strip("/") for path in paths)
+    files = tree_files(wit_directory, get_commit_tree(wit_directory, commit_name), sparse=paths)
+    entries = (
+        (prefix + file_name, files[file_name], get_blob_size(wit_directory, files[file_name]))
+        for file_name in sorted(files)
+    )
+    date = get_commit_date(wit_directory, commit_name)
+    if output is None or output == "-":
+        write_archive(wit_directory, entries, archive_format, date, sys.stdout.buffer)
+        return
+    with open(working_directory / output, 'wb') as out:
+        write_archive(wit_directory, entries, archive_format, date, out)
+
+
+def make_parser():
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--jobs', type=int, default=argparse.SUPPRESS, help="worker threads for file I/O")
+    common.add_argument(
+        '--profile', action='store_true', default=argparse.SUPPRESS, help="print time per phase and I/O counters"
+    )
+
+    parser = argparse.ArgumentParser(prog='wit', parents=[common])
+    commands = parser.add_subparsers(dest='command', metavar='command')
+
+    init_parser = commands.add_parser('init', parents=[common], help="create a wit repository")
+    init_parser.set_defaults(func=lambda args: init())
+
+    add_parser = commands.add_parser('add', parents=[common], help="stage files, directories or glob patterns")
+    add_parser.add_argument('paths', nargs='*')
+    add_parser.add_argument('-A', '--all', action='store_true', dest='all_files', help="stage every change in the tree")
+    add_parser.set_defaults(func=lambda args: add(*args.paths, all_files=args.all_files))
+
+    commit_parser = commands.add_parser('commit', parents=[common], help="commit the staged files")
+    commit_parser.add_argument('message', nargs='+')
+    commit_parser.set_defaults(func=lambda args: commit(" ".join(args.message)))
+
+    status_parser = commands.add_parser('status', parents=[common], help="show the working tree status")
+    status_parser.set_defaults(func=lambda args: status())
+
+    checkout_parser = commands.add_parser('checkout', parents=[common], help="switch to a branch or commit")
+    checkout_parser.add_argument('name', nargs='?', default=None)
+    checkout_parser.add_argument(
+        '--sparse', nargs='*', default=None, metavar='PATH',
+        help="only check out these paths (no paths: check out everything)"
+    )
+    checkout_parser.set_defaults(func=lambda args: checkout(args.name, sparse=args.sparse))
+
+    branch_parser = commands.add_parser('branch', parents=[common], help="create a branch at HEAD")
+    branch_parser.add_argument('name')
+    branch_parser.set_defaults(func=lambda args: branch(args.name))
+
+    merge_parser = commands.add_parser('merge', parents=[common], help="merge a branch into HEAD")
+    merge_parser.add_argument('branch_name')
+    merge_parser.set_defaults(func=lambda args: merge(args.branch_name))
+
+    log_parser = commands.add_parser('log', parents=[common], help="list the commit history")
+    log_parser.add_argument('--limit', type=int, default=None, help="show at most this many commits")
+    log_parser.add_argument('--skip', type=int, default=0, help="skip this many commits first")
+    log_parser.add_argument('--stat', action='store_true', help="show the files changed by each commit")
+    log_parser.set_defaults(func=lambda args: log(args.limit, args.skip, args.stat))
+
+    diff_parser = commands.add_parser('diff', parents=[common], help="show changes between commits or the working tree")
+    diff_parser.add_argument('first', nargs='?', default=None)
+    diff_parser.add_argument('second', nargs='?', default=None)
+    diff_parser.add_argument('--stat', action='store_true', help="only show a summary per file")
+    diff_parser.set_defaults(func=lambda args: diff(args.first, args.second, args.stat))
+
+    archive_parser = commands.add_parser('archive', parents=[common], help="export a commit as a tar or zip archive")
+    archive_parser.add_argument('name')
+    archive_parser.add_argument(
+        '--path', action='append', default=[], dest='paths', help="only include this file or directory (repeatable)"
+    )
+    archive_parser.add_argument('--format', choices=['tar', 'tar.gz', 'zip'], default='tar')
+    archive_parser.add_argument('-o', '--output', default=None, help="write to this file instead of stdout ('-')")
+    archive_parser.add_argument('--prefix', default="", help="prepend this to every path, e.g. 'project-1.0/'")
+    archive_parser.set_defaults(
+        func=lambda args: archive(args.name, args.format, args.output, args.prefix, args.paths)
+    )
+
+    graph_parser = commands.add_parser('graph', parents=[common], help="draw the commit history")
+    graph_parser.add_argument('--format', choices=['ascii', 'dot', 'svg', 'plot'], default='ascii')
+    graph_parser.add_argument('--limit', type=int, default=None, help="show at most this many commits")
+    graph_parser.add_argument('--since', default=None, help="only show commits after this date (YYYY-MM-DD)")
+    graph_parser.set_defaults(func=lambda args: graph(args.format, args.limit, args.since))
+
+    daemon_parser = commands.add_parser('daemon', parents=[common], help="watch the working tree for faster status")
+    daemon_parser.add_argument('--stop', action='store_true', help="stop the running daemon")
+    daemon_parser.set_defaults(func=lambda args: daemon(args.stop))
+
+    repack_parser = commands.add_parser('repack', parents=[common], help="pack all objects into one packfile")
+    repack_parser.set_defaults(func=lambda args: repack())
+
+    gc_parser = commands.add_parser('gc', parents=[common], help="clean up and repack the object store")
+    gc_parser.set_defaults(func=lambda args: gc())
+
+    shallow_parser = commands.add_parser('shallow', parents=[common], help="drop history beyond a depth")
+    shallow_parser.add_argument('--depth', type=int, required=True, help="commits to keep behind each branch")
+    shallow_parser.set_defaults(func=lambda args: shallow(args.depth))
+
+    fsck_parser = commands.add_parser('fsck', parents=[common], help="verify the object store")
+    fsck_parser.set_defaults(func=lambda args: fsck())
+
+    remote_parser = commands.add_parser('remote', parents=[common], help="list or add remote repositories")
+    remote_commands = remote_parser.add_subparsers(dest='action', metavar='action')
+    remote_add_parser = remote_commands.add_parser('add', parents=[common], help="add a remote repository path")
+    remote_add_parser.add_argument('name')
+    remote_add_parser.add_argument('path')
+    remote_parser.set_defaults(
+        func=lambda args: remote(args.action, getattr(args, 'name', None), getattr(args, 'path', None))
+    )
+
+    fetch_parser = commands.add_parser('fetch', parents=[common], help="download new commits from a remote")
+    fetch_parser.add_argument('remote_name')
+    fetch_parser.set_defaults(func=lambda args: fetch(args.remote_name))
+
+    push_parser = commands.add_parser('push', parents=[common], help="send a branch to a remote")
+    push_parser.add_argument('remote_name')
+    push_parser.add_argument('branch_name', nargs='?', default=None)
+    push_parser.set_defaults(func=lambda args: push(args.remote_name, args.branch_name))
+
+    worktree_parser = commands.add_parser('worktree', parents=[common], help="list or add linked working trees")
+    worktree_commands = worktree_parser.add_subparsers(dest='action', metavar='action')
+    worktree_add_parser = worktree_commands.add_parser(
+        'add', parents=[common], help="check out a branch in a new working tree"
+    )
+    worktree_add_parser.add_argument('path')
+    worktree_add_parser.add_argument('branch_name')
+    worktree_parser.set_defaults(
+        func=lambda args: worktree(args.action, getattr(args, 'path', None), getattr(args, 'branch_name', None))
+    )
+
+    batch_parser = commands.add_parser('batch', parents=[common], help="run many commands in one process")
+    batch_parser.add_argument('--socket', default=None, help="serve requests on this unix socket instead of stdin")
+    batch_parser.set_defaults(func=lambda args: batch(args.socket))
+
+    config_parser = commands.add_parser('config', parents=[common], help="set a repository setting")
+    config_parser.add_argument('key')
+    config_parser.add_argument('value')
+    config_parser.set_defaults(func=lambda args: config(args.key, args.value))
+
+    return parser
+
+
+def run_command(args):
+    global JOBS
+    if getattr(args, 'jobs', None) is not None:
+        JOBS = args.jobs
+    trace_path = os.environ.get('WIT_TRACE')
+    profile = getattr(args, 'profile', False)
+    if not (profile or trace_path):
+        args.func(args)
+        return
+    start_tracing()
+    try:
+        with span(args.command):
+            args.func(args)
+    finally:
+        tracer = stop_tracing()
+        if profile:
+            print_profile(tracer)
+        if trace_path:
+            write_trace(tracer, trace_path)
+
+
+def run_batch_request(parser, line):
+    global JOBS
+    request = json.loads(line) if line.startswith("{") else {'argv': shlex.split(line)}
+    argv = request.get('argv') or [request['command'], *request.get('args', [])]
+    output = io.StringIO()
+    error = None
+    jobs = JOBS
+    working_directory = os.getcwd()
+    WIT_FOLDERS.clear()
+    try:
+        with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+            if request.get('cwd') is not None:
+                os.chdir(request['cwd'])
+            args = parser.parse_args(argv)
+            if args.command in (None, 'batch', 'daemon'):
+                error = f"{args.command} is not available in batch mode"
+            elif args.command == 'archive' and args.output in (None, "-"):
+                error = "archive to stdout is not available in batch mode, use -o"
+            else:
+                run_command(args)
+    except SystemExit as exit_error:
+        lines = output.getvalue().strip().splitlines()
+        error = lines[-1] if lines else f"exit status {exit_error.code}"
+    except Exception as command_error:
+        error = f"{type(command_error).__name__}: {command_error}"
+    finally:
+        JOBS = jobs
+        os.chdir(working_directory)
+    if error is not None:
+        error = " ".join(error.split())
+    return request, output.getvalue(), error
+
+
+def batch_session(parser, in_stream, out_stream):
+    for line in in_stream:
+        line = line.strip()
+        if not line:
+            continue
+        if line in ('exit', 'shutdown'):
+            return line == 'exit'
+        try:
+            request, output, error = run_batch_request(parser, line)
+        except (ValueError, KeyError, TypeError) as request_error:
+            request, output, error = {}, "", f"invalid request: {request_error}"
+        if line.startswith("{"):
+            response = {'id': request.get('id'), 'ok': error is None, 'output': output, 'error': error}
+            out_stream.write(json.dumps(response) + "\n")
+        else:
+            if output and not output.endswith("\n"):
+                output += "\n"
+            out_stream.write(output + (f"wit-batch: error: {error}\n" if error else "wit-batch: ok\n"))
+        out_stream.flush()
+    return True
+
+
+def batch(socket_path=None):
+    parser = make_parser()
+    if socket_path is None:
+        batch_session(parser, sys.stdin, sys.stdout)
+        return
+
+    socket_path = Path(socket_path).resolve()
+    socket_path.unlink(missing_ok=True)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+        server.bind(os.fspath(socket_path))
+        server.listen()
+        print(f"batch listening on {socket_path}", flush=True)
+        try:
+            serving = True
+            while serving:
+                connection, _ = server.accept()
+                with connection, connection.makefile('rw', encoding='utf-8', newline="\n") as stream:
+                    serving = batch_session(parser, stream, stream)
+        finally:
+            socket_path.unlink(missing_ok=True)
+
+
+def main(argv=None):
+    parser = make_parser()
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help()
+        return
+    run_command(args)
+
+
+if __name__ == '__main__':
+    main()